@@ -57,14 +57,490 @@ Users would then access this mask with:
 'Cosmic ray'
 
 
+Whole mask columns can be decoded at once; only the unique mask values
+are decoded, then broadcast back to the rows:
+
+>>> import numpy as np
+>>> m = np.array([0, 16, 24, 16, 1], dtype=np.uint16)
+>>> ccdmask.bitarray(m)[:, ccdmask.names().index('COSMIC')]
+array([False,  True,  True,  True, False])
+>>> values, names, inverse = ccdmask.unique_names(m)
+>>> names
+[[], ['BAD'], ['COSMIC'], ['SATURATED', 'COSMIC']]
+>>> inverse
+array([0, 2, 3, 2, 1])
+
+Mask expressions may combine bits with ``|``, ``&``, ``~`` and
+parentheses.  Expressions are compiled once and cached, either into an
+integer mask or into a predicate that selects elements of a mask array:
+
+>>> ccdmask.mask('(BAD|HOT|DEAD)&~HOT')
+5
+>>> ccdmask.define('BADPIX', 'BAD|HOT|DEAD')
+>>> select = ccdmask.predicate('BADPIX & ~COSMIC')
+>>> select(np.array([1, 17, 16, 4]))
+array([ True, False, False,  True])
+
 .. _desispec: http://desispec.readthedocs.org
 """
+import os
+import re
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+import numpy as np
+
+
+def _as_unsigned(mask):
+    """Return an integer mask array viewed as the unsigned integer
+    type of the same width, so that the sign bit can be tested like any
+    other bit.
+    """
+    mask = np.asarray(mask)
+    if mask.dtype.kind == 'u':
+        return mask
+    elif mask.dtype.kind == 'i':
+        udtype = np.dtype('u{0:d}'.format(mask.dtype.itemsize))
+        return mask.view(udtype.newbyteorder(mask.dtype.byteorder))
+    else:
+        raise ValueError("Mask arrays must have an integer dtype, " +
+                         "not {0}.".format(mask.dtype))
+
+
+#
+# _byte_bits[b, j] is 1 if bit j is set in the byte value b.
+#
+_byte_bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis],
+                           axis=1)[:, ::-1].astype(np.int64)
+
+
+def _cast_bits(bits, dtype):
+    """Convert the integer `bits` to a scalar of the unsigned `dtype`,
+    dropping bits that do not fit; see :func:`_fits_bits`.
+    """
+    return np.array(bits, dtype=np.uint64).astype(dtype)[()]
+
+
+def _fits_bits(bits, dtype):
+    """Return ``True`` if all of the integer `bits` fit in `dtype`.
+    """
+    return (bits >> (8*np.dtype(dtype).itemsize)) == 0
+
+
+def _to_words(bits, nwords):
+    """Split the integer `bits` into an array of `nwords` 64-bit words,
+    least significant word first.
+    """
+    return np.array([(bits >> (64*k)) & 0xFFFFFFFFFFFFFFFF
+                     for k in range(nwords)], dtype=np.uint64)
+
+
+def _from_words(words):
+    """Join an array of 64-bit words, least significant word first, into
+    a single integer.
+    """
+    bits = 0
+    for k, w in enumerate(np.asarray(words, dtype=np.uint64).ravel()):
+        bits |= int(w) << (64*k)
+    return bits
+
+
+def _anyset(mask, bits, nwords=1):
+    """Return boolean array that is ``True`` where any of `bits` is set
+    in `mask`.  If `nwords` > 1, the last axis of `mask` holds the words.
+    """
+    mask = _as_unsigned(mask)
+    if nwords > 1:
+        return ((mask & _to_words(bits, nwords)) != 0).any(axis=-1)
+    return (mask & _cast_bits(bits, mask.dtype)) != 0
+
+
+def _allset(mask, bits, nwords=1):
+    """Return boolean array that is ``True`` where all of `bits` are set
+    in `mask`.  If `nwords` > 1, the last axis of `mask` holds the words.
+    The result is all ``False`` if the dtype of `mask` cannot hold `bits`.
+    """
+    mask = _as_unsigned(mask)
+    if nwords > 1:
+        words = _to_words(bits, nwords)
+        return ((mask & words) == words).all(axis=-1)
+    if not _fits_bits(bits, mask.dtype):
+        return np.zeros(mask.shape, dtype=bool)[()]
+    bits = _cast_bits(bits, mask.dtype)
+    return (mask & bits) == bits
+
+
+def dilate_mask(mask, bits, structure=None, tilesize=None):
+    """Grow selected bits of a 2D mask image into neighbouring pixels.
+
+    All selected bits are dilated together with bitwise shifts of the
+    integer image, one pass per element of the structuring element.  Bits
+    that are not selected are preserved unchanged.
+
+    Parameters
+    ----------
+    mask : :class:`~numpy.ndarray`
+        Two-dimensional integer mask image.
+    bits : :class:`int`
+        The bits to dilate, *e.g.* ``ccdmask.mask('COSMIC|SATURATED')``.
+    structure : :class:`~numpy.ndarray`, optional
+        Boolean structuring element with odd dimensions, centred on the
+        pixel.  Defaults to the 3x3 square.
+    tilesize : :class:`int`, optional
+        If set, process the image in tiles of this many rows, to limit
+        the memory used on very large images.
+
+    Returns
+    -------
+    :class:`~numpy.ndarray`
+        A new mask image with the selected bits dilated.
+    """
+    mask = np.asarray(mask)
+    if mask.ndim != 2:
+        raise ValueError("Only two-dimensional mask images can be dilated.")
+    if structure is None:
+        structure = np.ones((3, 3), dtype=bool)
+    structure = np.asarray(structure, dtype=bool)
+    if structure.ndim != 2 or structure.shape[0] % 2 == 0 or structure.shape[1] % 2 == 0:
+        raise ValueError("The structuring element must be 2D with odd dimensions.")
+    ry, rx = structure.shape[0] // 2, structure.shape[1] // 2
+    umask = _as_unsigned(mask)
+    bits = _cast_bits(bits, umask.dtype)
+    result = mask.copy()
+    uresult = _as_unsigned(result)
+    ny, nx = mask.shape
+    if tilesize is None:
+        tilesize = max(ny, 1)
+    offsets = [(i - ry, j - rx) for i, j in zip(*np.nonzero(structure))]
+    for y0 in range(0, ny, tilesize):
+        y1 = min(y0 + tilesize, ny)
+        lo = max(y0 - ry, 0)
+        selected = umask[lo:min(y1 + ry, ny)] & bits
+        for oy, ox in offsets:
+            #
+            # Pixel (y, x) receives the selected bits of pixel (y-oy, x-ox).
+            #
+            ys, ye = max(y0, oy), min(y1, ny + oy)
+            xs, xe = max(0, ox), min(nx, nx + ox)
+            if ys >= ye or xs >= xe:
+                continue
+            target = uresult[ys:ye, xs:xe]
+            np.bitwise_or(target, selected[ys-oy-lo:ye-oy-lo, xs-ox:xe-ox],
+                          out=target)
+    return result
+
+
+def reduce_masks(masks, op='or', bitmask=None):
+    """Combine a stream of mask arrays with bitwise OR or AND.
+
+    Only one input frame is held in memory at a time, in addition to the
+    output and the optional counts.
+
+    Parameters
+    ----------
+    masks : iterable
+        Mask arrays of identical shape, or FITS HDUs containing them
+        (anything with a ``data`` attribute), *e.g.* a generator reading
+        one exposure at a time.
+    op : :class:`str`, optional
+        'or' (default) or 'and'.
+    bitmask : :class:`BitMask`, optional
+        If given, also count, for each pixel, how many inputs set each
+        of the defined bits.
+
+    Returns
+    -------
+    :class:`~numpy.ndarray` or :func:`tuple`
+        The combined mask.  If `bitmask` is given, a tuple of the combined
+        mask and an array of counts of shape ``(nbits,) + shape``, in the
+        order of :meth:`BitMask.names`.
+
+    Raises
+    ------
+    ValueError
+        If `op` is not valid, if `masks` is empty or if the shapes do not
+        match.
+    """
+    ufuncs = {'or': np.bitwise_or, 'and': np.bitwise_and}
+    try:
+        ufunc = ufuncs[op]
+    except KeyError:
+        raise ValueError("Unknown mask reduction '{0}'.".format(op))
+    result = None
+    counts = None
+    for item in masks:
+        frame = np.asarray(item.data if hasattr(item, 'data') else item)
+        if result is None:
+            result = frame.astype(frame.dtype.newbyteorder('='))
+        else:
+            if frame.shape != result.shape:
+                raise ValueError("Mask shapes do not match: {0} != {1}.".format(
+                    frame.shape, result.shape))
+            ufunc(result, frame, out=result)
+        if bitmask is not None:
+            uframe = bitmask._words(frame)
+            nwords = bitmask.nwords
+            shape = uframe.shape[:-1] if nwords > 1 else uframe.shape
+            if counts is None:
+                counts = np.zeros((len(bitmask.names()),) + shape, dtype=np.int32)
+                bitset = np.empty(shape, dtype=bool)
+                scratch = np.empty(shape, dtype=uframe.dtype)
+            for k, name in enumerate(bitmask.names()):
+                bitnum = bitmask.bitnum(name)
+                if nwords > 1:
+                    word = uframe[..., bitnum // 64]
+                    bits = np.uint64(2**(bitnum % 64))
+                else:
+                    word = uframe
+                    bits = _cast_bits(2**bitnum, uframe.dtype)
+                np.bitwise_and(word, bits, out=scratch)
+                np.not_equal(scratch, 0, out=bitset)
+                np.add(counts[k], bitset, out=counts[k])
+    if result is None:
+        raise ValueError("No masks to reduce.")
+    if bitmask is not None:
+        return result, counts
+    return result
+
+
+class _LRUCache(object):
+    """Small least-recently-used cache.
+
+    :func:`functools.lru_cache` is not available in Python 2, and it would
+    keep :class:`BitMask` objects alive if used on methods.  Lookups
+    and updates take a lock, so the cache may be shared between threads;
+    use :meth:`get` rather than testing ``key in cache`` before
+    ``cache[key]``, which another thread may invalidate in between.
+
+    Parameters
+    ----------
+    maxsize : :class:`int`, optional
+        Maximum number of entries to keep.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Return the value of `key`, or `default` if it is not cached.
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __getstate__(self):
+        #- Locks cannot be pickled, and cached predicates are closures.
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+
+_token_re = re.compile(r'\s*(?:([()|&~])|([^\s()|&~]+))')
+
+
+def _tokenize(expr):
+    """Split a mask expression into a list of tokens.
+
+    Operands are any runs of characters other than whitespace and the
+    operators, so that bit names need not be identifiers.
+    """
+    tokens = list()
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        m = _token_re.match(expr, pos)
+        if m is None:
+            raise ValueError("Invalid character in mask expression " +
+                             "'{0}' at position {1:d}.".format(expr, pos))
+        tokens.append(m.group(1) or m.group(2))
+        pos = m.end()
+    return tokens
+
+
+def _parse(expr, lookup):
+    """Parse a mask expression into a tree of nested tuples.
+
+    The grammar, in order of increasing precedence, is ``a | b``,
+    ``a & b``, ``~a`` and ``(a)``.  Leaves are ``('bit', bitnum)``;
+    other nodes are ``('or', children)``, ``('and', children)`` and
+    ``('not', child)``.
+
+    Parameters
+    ----------
+    expr : :class:`str`
+        The expression.
+    lookup : callable
+        Function returning the parse tree of a bit name or number.
+
+    Returns
+    -------
+    :func:`tuple`
+        The parse tree.
+    """
+    tokens = _tokenize(expr)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def advance():
+        pos[0] += 1
+        return tokens[pos[0] - 1]
+
+    def binary(op, operand):
+        children = [operand()]
+        while peek() == op:
+            advance()
+            children.append(operand())
+        if len(children) == 1:
+            return children[0]
+        return ({'|': 'or', '&': 'and'}[op], tuple(children))
+
+    def factor():
+        token = peek()
+        if token is None:
+            raise ValueError("Unexpected end of mask expression '{0}'.".format(expr))
+        advance()
+        if token == '~':
+            return ('not', factor())
+        if token == '(':
+            node = disjunction()
+            if peek() != ')':
+                raise ValueError("Unbalanced parentheses in mask expression '{0}'.".format(expr))
+            advance()
+            return node
+        if token in ('|', '&', ')'):
+            raise ValueError("Unexpected '{0}' in mask expression '{1}'.".format(token, expr))
+        return lookup(token)
+
+    def conjunction():
+        return binary('&', factor)
+
+    def disjunction():
+        return binary('|', conjunction)
+
+    tree = disjunction()
+    if peek() is not None:
+        raise ValueError("Unexpected '{0}' in mask expression '{1}'.".format(peek(), expr))
+    return tree
+
+
+#
+# Process-wide memory of parsed definition files and BitMask objects.
+#
+_bitdefs_memo = dict()
+_bitmask_memo = dict()
+
+
+def _bitdefs_cachedir():
+    """Return the directory of cached bit definitions.
+
+    This is ``$DESIUTIL_CACHE`` if set, otherwise ``~/.cache/desiutil``.
+    """
+    return os.environ.get('DESIUTIL_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'desiutil'))
+
+
+def _load_bitdefs(filename, cachedir=None):
+    """Load bit definitions from a YAML file, using a JSON cache.
+
+    The cache directory may be shared, so the cache files are JSON, which
+    cannot execute code when loaded, rather than pickles.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        YAML file.
+    cachedir : :class:`str`, optional
+        Directory for cache files, by default :func:`_bitdefs_cachedir`.
+        Use ``False`` to disable the cache file.
+
+    Returns
+    -------
+    :func:`tuple`
+        The memo key of the file, and the bit definitions.
+    """
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    key = (filename, st.st_mtime, st.st_size)
+    if key in _bitdefs_memo:
+        return key, _bitdefs_memo[key]
+    with open(filename, 'rb') as f:
+        content = f.read()
+    if cachedir is None:
+        cachedir = _bitdefs_cachedir()
+    bitdefs = None
+    cachefile = None
+    if cachedir:
+        cachefile = os.path.join(cachedir, 'bitdefs-{0}-{1:d}.json'.format(
+            hashlib.sha1(content).hexdigest(), int(st.st_mtime)))
+        try:
+            with open(cachefile, 'r') as f:
+                bitdefs = json.load(f)
+        except (IOError, OSError, ValueError):
+            bitdefs = None
+        if not isinstance(bitdefs, dict):
+            bitdefs = None
+    if bitdefs is None:
+        import yaml
+        bitdefs = yaml.safe_load(content)
+        if cachefile is not None:
+            #
+            # Write to a temporary file, then rename, so that concurrent
+            # processes never read a partial file.  The cache is optional,
+            # so failures, e.g. on read-only file systems, are ignored.
+            #
+            try:
+                from tempfile import mkstemp
+                if not os.path.isdir(cachedir):
+                    os.makedirs(cachedir)
+                text = json.dumps(bitdefs)
+                fd, tmpfile = mkstemp(dir=cachedir)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(text)
+                os.rename(tmpfile, cachefile)
+            except (IOError, OSError, TypeError, ValueError):
+                #- TypeError: values that JSON cannot represent, e.g. dates
+                pass
+    _bitdefs_memo[key] = bitdefs
+    return key, bitdefs
+
 
 class _MaskBit(int):
     """A single mask bit.
 
     Subclasses :class:`int` to act like an :class:`int`, but allows the
     ability to extend with blat.name, blat.comment, blat.mask, blat.bitnum.
+    Only the name, comment and extra values are stored per instance;
+    `mask` and `bitnum` are derived from the value.
 
     Attributes
     ----------
@@ -80,8 +556,6 @@ class _MaskBit(int):
     def __new__(cls, name, bitnum, comment, extra=dict()):
         self = super(_MaskBit, cls).__new__(cls, 2**bitnum)
         self.name = name
-        self.bitnum = bitnum
-        self.mask = 2**bitnum
         self.comment = comment
         self._extra = extra
         for key, value in extra.items():
@@ -91,6 +565,31 @@ class _MaskBit(int):
             self.__dict__[key] = value
         return self
 
+    @property
+    def bitnum(self):
+        """The number of the bit.
+        """
+        return int(self).bit_length() - 1
+
+    @property
+    def mask(self):
+        """The value of the bit, ``2**bitnum``.
+        """
+        return int(self)
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_frozen', False):
+            raise AttributeError("Bits of a FrozenBitMask are immutable.")
+        super(_MaskBit, self).__setattr__(name, value)
+
+    def __delattr__(self, name):
+        if self.__dict__.get('_frozen', False):
+            raise AttributeError("Bits of a FrozenBitMask are immutable.")
+        super(_MaskBit, self).__delattr__(name)
+
+    def __reduce__(self):
+        return (_MaskBit, (self.name, self.bitnum, self.comment, self._extra))
+
     def __str__(self):
         return ('{0.name:16s} bit {0.bitnum} mask 0x{0.mask:X} - ' +
                 '{0.comment}').format(self)
@@ -116,29 +615,322 @@ class BitMask(object):
         Dictionary of different mask bit definitions;
         each value is a list of ``[bitname, bitnum, comment]``.
         A 4th entry is optional, which must be a dictionary.
+
+    Notes
+    -----
+    Bit numbers of 64 and above are allowed.  Mask arrays of such masks
+    have an extra last axis of length :attr:`nwords`, holding unsigned
+    64-bit words, least significant word first; see :meth:`mask_words`.
     """
 
     def __init__(self, name, bitdefs):
         """Init.
         """
         self._bits = dict()
+        #
+        # The bits indexed by bit number, None for undefined bits.  Names,
+        # comments and masks by number are all looked up through this list.
+        #
+        self._bitlist = list()
         self._name = name
+        self._defines = dict()
+        self._cache = _LRUCache()
+        #
+        # Parsed name strings of from_strings are cached separately, so
+        # that catalogs with many distinct strings do not evict the
+        # compiled expressions.
+        #
+        self._strings_cache = _LRUCache(maxsize=4096)
         for x in bitdefs[name]:
             bitname, bitnum, comment = x[0:3]
             if len(x) == 4:
-                extra = x[3]
-                if not isinstance(extra, dict):
+                if not isinstance(x[3], dict):
                     raise ValueError(
                         '{} extra values should be a dict'.format(bitname))
+                bit = _MaskBit(bitname, bitnum, comment, x[3])
             else:
-                extra = dict()
-            self._bits[bitname] = _MaskBit(bitname, bitnum, comment, extra)
-            self._bits[bitnum] = self._bits[bitname]
+                bit = _MaskBit(bitname, bitnum, comment)
+            self._bits[bitname] = bit
+            if bitnum >= len(self._bitlist):
+                self._bitlist.extend([None] * (bitnum + 1 - len(self._bitlist)))
+            self._bitlist[bitnum] = bit
+        self._allbits = sum([bit.mask for bit in self._bitlist if bit is not None])
+
+    @classmethod
+    def from_yaml(cls, filename, name, cachedir=None):
+        """Load a bitmask from a YAML file of bit definitions.
+
+        The parsed definitions are cached in a JSON file, keyed by the
+        hash and modification time of `filename`, so later processes skip
+        parsing the YAML.  Within a process, the definitions are parsed
+        once per unchanged file.  Since a :class:`BitMask` can be changed
+        with :meth:`define`, each call returns a new object; the same
+        object is only shared for :class:`FrozenBitMask`, *e.g.*
+        ``FrozenBitMask.from_yaml(filename, name)``.
+
+        Parameters
+        ----------
+        filename : :class:`str`
+            YAML file with mask bit definitions.
+        name : :class:`str`
+            Name of the mask, must be a key in `filename`.
+        cachedir : :class:`str`, optional
+            Directory for cache files.  Defaults to ``$DESIUTIL_CACHE``
+            or ``~/.cache/desiutil``; use ``False`` to disable the cache file.
+
+        Returns
+        -------
+        :class:`BitMask`
+            The bitmask.
+        """
+        key, bitdefs = _load_bitdefs(filename, cachedir=cachedir)
+        if not issubclass(cls, FrozenBitMask):
+            return cls(name, bitdefs)
+        key = key + (cls, name)
+        if key not in _bitmask_memo:
+            _bitmask_memo[key] = cls(name, bitdefs)
+        return _bitmask_memo[key]
+
+    def to_header(self, header, prefix='BM'):
+        """Write the bit definitions to a FITS header or table metadata.
+
+        The mask name is stored in ``BMNAME``; the name, number and
+        comment of each bit are stored in indexed keywords ``BMNAMnn``,
+        ``BMNUMnn`` and ``BMCOMnn``, similar to :func:`desiutil.depend.setdep`.
+        Any previous definitions with the same `prefix` are replaced.
+        Extra bit values are not stored.
+
+        Parameters
+        ----------
+        header : dict-like
+            *e.g.* :class:`astropy.io.fits.Header` or ``Table.meta``.
+        prefix : :class:`str`, optional
+            Keyword prefix of at most two characters, to allow several
+            masks in the same header.
+        """
+        if len(prefix) > 2:
+            raise ValueError("Keyword prefix '{0}' is longer than two characters.".format(prefix))
+        header[prefix + 'NAME'] = self._name
+        bits = [bit for bit in self._bitlist if bit is not None]
+        for i, bit in enumerate(bits):
+            header['{0}NAM{1:02d}'.format(prefix, i)] = bit.name
+            header['{0}NUM{1:02d}'.format(prefix, i)] = bit.bitnum
+            header['{0}COM{1:02d}'.format(prefix, i)] = bit.comment
+        i = len(bits)
+        while '{0}NAM{1:02d}'.format(prefix, i) in header:
+            for key in ('NAM', 'NUM', 'COM'):
+                keyword = '{0}{1}{2:02d}'.format(prefix, key, i)
+                if keyword in header:
+                    del header[keyword]
+            i += 1
+
+    @classmethod
+    def from_header(cls, header, prefix='BM'):
+        """Create a bitmask from definitions written by :meth:`to_header`.
+
+        Parameters
+        ----------
+        header : dict-like
+            *e.g.* :class:`astropy.io.fits.Header` or ``Table.meta``.
+        prefix : :class:`str`, optional
+            Keyword prefix.
+
+        Returns
+        -------
+        :class:`BitMask`
+            The bitmask.
+
+        Raises
+        ------
+        KeyError
+            If there are no bit definitions in `header`.
+        """
+        name = header[prefix + 'NAME']
+        bitdefs = list()
+        i = 0
+        while '{0}NAM{1:02d}'.format(prefix, i) in header:
+            bitdefs.append([header['{0}NAM{1:02d}'.format(prefix, i)],
+                            int(header['{0}NUM{1:02d}'.format(prefix, i)]),
+                            header.get('{0}COM{1:02d}'.format(prefix, i), '')])
+            i += 1
+        return cls(name, {name: bitdefs})
+
+    def _bitdefs(self):
+        """Return the bit definitions in the form accepted by :meth:`__init__`.
+        """
+        bitdefs = list()
+        for bit in self._bitlist:
+            if bit is None:
+                continue
+            if len(bit._extra) > 0:
+                bitdefs.append([bit.name, bit.bitnum, bit.comment, bit._extra])
+            else:
+                bitdefs.append([bit.name, bit.bitnum, bit.comment])
+        return {self._name: bitdefs}
+
+    def __reduce__(self):
+        """Pickle only the name, the bit definitions and named expressions.
+        """
+        return (self.__class__, (self._name, self._bitdefs()),
+                {'_defines': self._defines})
+
+    def freeze(self):
+        """Return an immutable, hashable copy of this bitmask.
+
+        Returns
+        -------
+        :class:`FrozenBitMask`
+            The frozen bitmask.  Named sub-expressions are not copied.
+        """
+        return FrozenBitMask(self._name, self._bitdefs())
+
+    @property
+    def _bitnums(self):
+        """Numbers of the defined bits, in increasing order.
+        """
+        return [bitnum for bitnum, bit in enumerate(self._bitlist) if bit is not None]
+
+    def _bit(self, bitname_or_num):
+        """Return the bit with this name or number.
+
+        Raises
+        ------
+        KeyError
+            If there is no such bit.
+        """
+        if isinstance(bitname_or_num, int):
+            if 0 <= bitname_or_num < len(self._bitlist):
+                bit = self._bitlist[bitname_or_num]
+                if bit is not None:
+                    return bit
+            raise KeyError(bitname_or_num)
+        return self._bits[bitname_or_num]
 
     def __getitem__(self, bitname):
         """Return mask for individual bitname.
         """
-        return self._bits[bitname]
+        return self._bit(bitname)
+
+    @property
+    def nwords(self):
+        """Number of 64-bit words needed to hold all defined bits.
+        """
+        return (len(self._bitlist) - 1) // 64 + 1 if self._bitlist else 1
+
+    def mask_words(self, name_or_num):
+        """Return mask value split into 64-bit words.
+
+        Parameters
+        ----------
+        name_or_num : :class:`int` or :class:`str`
+            Name or number of the bit, or a mask expression, as
+            in :meth:`mask`.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            Array of :attr:`nwords` unsigned 64-bit words, least
+            significant word first.
+        """
+        return _to_words(self.mask(name_or_num), self.nwords)
+
+    @property
+    def dtype(self):
+        """Smallest unsigned integer type that holds all defined bits.
+
+        For multi-word masks this is the type of each word.
+        """
+        maxbit = len(self._bitlist) - 1 if self._bitlist and self.nwords == 1 else 63
+        for dtype in (np.uint8, np.uint16, np.uint32):
+            if maxbit < 8*np.dtype(dtype).itemsize:
+                return np.dtype(dtype)
+        return np.dtype(np.uint64)
+
+    def _shape(self, shape):
+        """Return the shape of a mask array, adding the word axis of
+        multi-word masks.
+        """
+        if isinstance(shape, (int, np.integer)):
+            shape = (shape,)
+        shape = tuple(shape)
+        if self.nwords > 1:
+            shape = shape + (self.nwords,)
+        return shape
+
+    def empty(self, shape):
+        """Return a new, uninitialized mask array of type :attr:`dtype`.
+
+        Parameters
+        ----------
+        shape : :class:`int` or :func:`tuple`
+            Shape of the array, not including the word axis of
+            multi-word masks.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            The mask array.
+        """
+        return np.empty(self._shape(shape), dtype=self.dtype)
+
+    def zeros(self, shape):
+        """Return a new mask array of type :attr:`dtype` with no bits set.
+
+        Parameters
+        ----------
+        shape : :class:`int` or :func:`tuple`
+            Shape of the array, not including the word axis of
+            multi-word masks.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            The mask array.
+        """
+        return np.zeros(self._shape(shape), dtype=self.dtype)
+
+    def downcast(self, mask):
+        """Convert a mask array to the smallest type holding all defined bits.
+
+        Parameters
+        ----------
+        mask : :class:`~numpy.ndarray`
+            Integer mask array, *e.g.* an ``int32`` or ``int64`` column.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            The mask converted to :attr:`dtype`.
+
+        Raises
+        ------
+        ValueError
+            If any bit that is not defined is set in `mask`, since it
+            could be lost in the conversion.
+        """
+        umask = self._words(mask)
+        if self.nwords > 1:
+            setbits = _from_words(np.bitwise_or.reduce(
+                umask.reshape(-1, self.nwords), axis=0))
+        else:
+            setbits = int(np.bitwise_or.reduce(umask, axis=None))
+        undefined = setbits & ~self._allbits
+        if undefined:
+            raise ValueError("Undefined bits are set in mask: {0}.".format(
+                ', '.join(self.names(undefined))))
+        return umask.astype(self.dtype)
+
+    def _words(self, mask):
+        """Return mask array as unsigned integers, checking the word axis
+        of multi-word masks.
+        """
+        mask = _as_unsigned(mask)
+        nwords = self.nwords
+        if nwords > 1 and (mask.ndim == 0 or mask.shape[-1] != nwords or
+                           mask.dtype.itemsize != 8):
+            raise ValueError(("Mask arrays of {0} must be 64-bit with last " +
+                              "axis of length {1:d}.").format(self._name, nwords))
+        return mask
 
     def bitnum(self, bitname):
         """Return bit number (int) for bitname (string).
@@ -168,7 +960,7 @@ class BitMask(object):
         :class:`str`
             The name of the bit.
         """
-        return self._bits[bitnum].name
+        return self._bit(bitnum).name
 
     def comment(self, bitname_or_num):
         """Return comment for this bit name or bit number.
@@ -183,7 +975,7 @@ class BitMask(object):
         :class:`str`
             The comment string.
         """
-        return self._bits[bitname_or_num].comment
+        return self._bit(bitname_or_num).comment
 
     def mask(self, name_or_num):
         """Return mask value.
@@ -205,14 +997,361 @@ class BitMask(object):
         8
         >>> bitmask.mask('BLAT')
         >>> bitmask.mask('BLAT|FOO')
+        >>> bitmask.mask('~BLAT')   # all defined bits except BLAT
+
+        Notes
+        -----
+        A string is interpreted as a mask expression with bitwise
+        semantics: ``|`` is OR, ``&`` is AND and ``~`` is the complement
+        with respect to all defined bits.  The result is cached.
+        """
+        if isinstance(name_or_num, int) or name_or_num in self._bits:
+            return self._bit(name_or_num).mask
+        key = ('mask', name_or_num)
+        value = self._cache.get(key)
+        if value is None:
+            value = self._evaluate(self._compile(name_or_num))
+            self._cache[key] = value
+        return value
+
+    def define(self, name, expr):
+        """Define a named sub-expression that may be used in later
+        mask expressions.
+
+        Parameters
+        ----------
+        name : :class:`str`
+            Name of the sub-expression; it must not be the name of a bit.
+        expr : :class:`str`
+            The mask expression, *e.g.* ``'BAD|HOT|DEAD'``.
+
+        Raises
+        ------
+        ValueError
+            If `name` is not a valid name or is already a bit name.
+        """
+        if re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name) is None:
+            raise ValueError("Invalid expression name '{0}'.".format(name))
+        if name in self._bits:
+            raise ValueError("'{0}' is already a bit name.".format(name))
+        self._defines[name] = self._compile(expr)
+        self._cache.clear()
+
+    def predicate(self, expr):
+        """Return a function that selects elements of a mask array.
+
+        Parameters
+        ----------
+        expr : :class:`str`
+            The mask expression.  Here a bit name is true if that bit
+            is set, ``|`` is logical OR, ``&`` is logical AND and ``~``
+            is logical NOT, *e.g.* ``'(BAD|HOT)&~COSMIC'``.
+
+        Returns
+        -------
+        callable
+            A function taking an integer mask array and returning a
+            boolean array of the same shape.  The function is cached.
         """
-        if isinstance(name_or_num, int):
-            return self._bits[name_or_num].mask
+        key = ('predicate', expr)
+        f = self._cache.get(key)
+        if f is None:
+            f = self._predicate(self._compile(expr))
+            self._cache[key] = f
+        return f
+
+    def select(self, mask, any=None, all=None, none=None, indices=False,
+               chunksize=65536, nthreads=1):
+        """Select elements of a mask array by which bits are set.
+
+        The predicate "any of `any`, all of `all` and none of `none`" is
+        evaluated in chunks of `chunksize` elements, reusing preallocated
+        scratch buffers, so no temporary arrays of the size of `mask`
+        are created.
+
+        Parameters
+        ----------
+        mask : :class:`~numpy.ndarray`
+            Integer mask array.
+        any : :class:`str` or :class:`list`, optional
+            Select elements with at least one of these bits set.
+        all : :class:`str` or :class:`list`, optional
+            Select elements with all of these bits set.
+        none : :class:`str` or :class:`list`, optional
+            Select elements with none of these bits set.
+        indices : :class:`bool`, optional
+            If ``True``, return the indices of the selected elements of
+            the flattened `mask` instead of a boolean array.
+        chunksize : :class:`int`, optional
+            Number of elements processed at a time.
+        nthreads : :class:`int`, optional
+            Number of threads sharing the work, useful for very large
+            arrays; the numpy operations release the GIL.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            Boolean array of the same shape as `mask` (without the word
+            axis of multi-word masks), or an array of indices if
+            `indices` is ``True``.
+
+        Notes
+        -----
+        Bits may be given as a mask expression, *e.g.* ``'BAD|HOT'``,
+        or as a list of bit names or numbers.  A constraint that is given
+        always applies, even if it evaluates to no bits: *e.g.*
+        ``any=[]`` or ``any='BAD&HOT'`` selects nothing.  Bits that do
+        not fit in the dtype of `mask` are never set.
+        """
+        nwords = self.nwords
+        umask = self._words(mask)
+        bits = [self._select_bits(b) for b in (any, all, none)]
+        if nwords > 1:
+            shape = umask.shape[:-1]
+            umask = umask.reshape(-1, nwords)
+            anybits, allbits, nonebits = [_to_words(b, nwords) for b in bits]
+            allfits = True
         else:
-            mask = 0
-            for name in name_or_num.split('|'):
-                mask |= self._bits[name].mask
-            return mask
+            shape = umask.shape
+            umask = umask.ravel()
+            anybits, allbits, nonebits = [_cast_bits(b, umask.dtype)
+                                          for b in bits]
+            allfits = _fits_bits(bits[1], umask.dtype)
+        nelem = umask.shape[0]
+        result = np.empty(nelem, dtype=bool)
+        #
+        # A constraint applies whenever it is given, even if its bits are
+        # zero: any of no bits is never true.  Bits that cannot be stored
+        # in the dtype of mask are never set.
+        #
+        if (any is not None and not np.any(anybits)) or not allfits:
+            result[:] = False
+            if indices:
+                return np.flatnonzero(result)
+            return result.reshape(shape)
+
+        def work(start_stop):
+            start, stop = start_stop
+            n = min(chunksize, stop - start)
+            scratch = np.empty((n,) + umask.shape[1:], dtype=umask.dtype)
+            test = np.empty(n, dtype=bool)
+            for i in range(start, stop, chunksize):
+                j = min(i + chunksize, stop)
+                x, s, t, r = umask[i:j], scratch[:j-i], test[:j-i], result[i:j]
+                if any is not None:
+                    np.bitwise_and(x, anybits, out=s)
+                    if nwords > 1:
+                        np.any(s != 0, axis=-1, out=r)
+                    else:
+                        np.not_equal(s, 0, out=r)
+                else:
+                    r[:] = True
+                if all is not None:
+                    np.bitwise_and(x, allbits, out=s)
+                    if nwords > 1:
+                        np.all(s == allbits, axis=-1, out=t)
+                    else:
+                        np.equal(s, allbits, out=t)
+                    np.logical_and(r, t, out=r)
+                if none is not None:
+                    np.bitwise_and(x, nonebits, out=s)
+                    if nwords > 1:
+                        np.all(s == 0, axis=-1, out=t)
+                    else:
+                        np.equal(s, 0, out=t)
+                    np.logical_and(r, t, out=r)
+
+        edges = np.linspace(0, nelem, max(nthreads, 1) + 1).astype(int)
+        ranges = [(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+        if len(ranges) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(len(ranges))
+            try:
+                pool.map(work, ranges)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for r in ranges:
+                work(r)
+        if indices:
+            return np.flatnonzero(result)
+        return result.reshape(shape)
+
+    def bitcounts(self, mask, chunksize=1048576):
+        """Count the number of elements of a mask array with each bit set.
+
+        All bits are counted in a single pass: a histogram of the values
+        of each byte of the mask is accumulated, then converted to bit
+        counts with a lookup table.  The array is read in blocks along its
+        first axis, so memory-mapped images (*e.g.* ``hdu.data``) are never
+        loaded at once.
+
+        Parameters
+        ----------
+        mask : :class:`~numpy.ndarray`
+            Integer mask array.
+        chunksize : :class:`int`, optional
+            Approximate number of elements read at a time.
+
+        Returns
+        -------
+        :class:`~collections.OrderedDict`
+            Number of elements with each defined bit set, keyed by bit
+            name in bit number order.  Bits that are set but not
+            defined are included as ``UNKNOWNnn``, as in :meth:`names`.
+        """
+        umask = self._words(mask)
+        if umask.ndim == 0:
+            umask = umask.reshape(1)
+        #
+        # Multi-word masks are counted as one wide integer per element.
+        #
+        nbytes = umask.dtype.itemsize * (self.nwords if self.nwords > 1 else 1)
+        little = umask.dtype.newbyteorder('<')
+        hist = np.zeros((nbytes, 256), dtype=np.int64)
+        rowsize = max(umask.size // max(umask.shape[0], 1), 1)
+        nrows = max(chunksize // rowsize, 1)
+        for i in range(0, umask.shape[0], nrows):
+            block = umask[i:i+nrows].astype(little).reshape(-1)
+            octets = block.view(np.uint8).reshape(-1, nbytes)
+            for k in range(nbytes):
+                hist[k] += np.bincount(octets[:, k], minlength=256)
+        bitcount = hist.dot(_byte_bits).ravel()
+        counts = OrderedDict()
+        nbits = len(self._bitlist)
+        for bitnum, n in enumerate(bitcount):
+            if bitnum < nbits and self._bitlist[bitnum] is not None:
+                counts[self._bitlist[bitnum].name] = int(n)
+            elif n > 0:
+                counts['UNKNOWN' + str(bitnum)] = int(n)
+        return counts
+
+    def format_counts(self, counts, total=None):
+        """Format bit counts as a summary table.
+
+        Parameters
+        ----------
+        counts : :class:`dict`
+            Bit counts keyed by bit name, as returned by :meth:`bitcounts`.
+        total : :class:`int`, optional
+            Total number of elements; if given, the fraction of elements
+            with each bit set is also shown.
+
+        Returns
+        -------
+        :class:`str`
+            The summary, one line per bit, including the bit comment.
+        """
+        lines = list()
+        if total is None:
+            lines.append('{0:16s} {1:>4s} {2:>12s}  {3}'.format(
+                'Name', 'Bit', 'Count', 'Comment'))
+        else:
+            lines.append('{0:16s} {1:>4s} {2:>12s} {3:>9s}  {4}'.format(
+                'Name', 'Bit', 'Count', 'Fraction', 'Comment'))
+        for name, n in counts.items():
+            if name in self._bits:
+                bitnum = self._bits[name].bitnum
+                comment = self._bits[name].comment
+            else:
+                bitnum = int(name[len('UNKNOWN'):])
+                comment = ''
+            if total is None:
+                line = '{0:16s} {1:4d} {2:12d}  {3}'.format(
+                    name, bitnum, n, comment)
+            else:
+                frac = float(n)/total if total > 0 else 0.0
+                line = '{0:16s} {1:4d} {2:12d} {3:9.6f}  {4}'.format(
+                    name, bitnum, n, frac, comment)
+            lines.append(line.rstrip())
+        return '\n'.join(lines)
+
+    def _select_bits(self, bits):
+        """Convert the bit specification of :meth:`select` to an integer mask.
+        """
+        if bits is None:
+            return 0
+        if isinstance(bits, (list, tuple)):
+            m = 0
+            for b in bits:
+                m |= self.mask(b)
+            return m
+        return self.mask(bits)
+
+    def _lookup(self, token):
+        """Return the parse tree of a bit name, bit number or
+        sub-expression name.
+        """
+        if token in self._defines:
+            return self._defines[token]
+        if token not in self._bits and token.isdigit():
+            token = int(token)
+        return ('bit', self._bit(token).bitnum)
+
+    def _compile(self, expr):
+        """Return the (cached) parse tree of a mask expression.
+        """
+        key = ('parse', expr)
+        tree = self._cache.get(key)
+        if tree is None:
+            tree = _parse(expr, self._lookup)
+            self._cache[key] = tree
+        return tree
+
+    def _evaluate(self, node):
+        """Evaluate a parse tree as an integer mask.
+        """
+        op = node[0]
+        if op == 'bit':
+            return 2**node[1]
+        elif op == 'not':
+            return self._allbits & ~self._evaluate(node[1])
+        values = [self._evaluate(child) for child in node[1]]
+        mask = values[0]
+        for v in values[1:]:
+            if op == 'or':
+                mask |= v
+            else:
+                mask &= v
+        return mask
+
+    def _predicate(self, node):
+        """Convert a parse tree into a function selecting mask array elements.
+        """
+        op = node[0]
+        if op == 'bit':
+            bits = 2**node[1]
+            return lambda x: _anyset(x, bits, self.nwords)
+        elif op == 'not':
+            f = self._predicate(node[1])
+            return lambda x: ~f(x)
+        #
+        # Merge single bits into one test: (x & m) != 0 for OR,
+        # (x & m) == m for AND.
+        #
+        bits = 0
+        funcs = list()
+        for child in node[1]:
+            if child[0] == 'bit':
+                bits |= 2**child[1]
+            else:
+                funcs.append(self._predicate(child))
+        if bits:
+            if op == 'or':
+                funcs.insert(0, lambda x: _anyset(x, bits, self.nwords))
+            else:
+                funcs.insert(0, lambda x: _allset(x, bits, self.nwords))
+        if len(funcs) == 1:
+            return funcs[0]
+        combine = np.logical_or if op == 'or' else np.logical_and
+
+        def f(x):
+            result = funcs[0](x)
+            for g in funcs[1:]:
+                combine(result, g(x), out=result)
+            return result
+        return f
 
     def names(self, mask=None):
         """Return list of names of masked bits.
@@ -221,38 +1360,204 @@ class BitMask(object):
         ----------
         mask : :class:`int`, optional
             The mask integer to convert to names. If not supplied,
-            return names of all known bits.
+            return names of all known bits.  For multi-word masks, this
+            may also be an array of :attr:`nwords` words.
 
         Returns
         -------
         :class:`list`
             The list of names contained in the mask.
         """
-        names = list()
         if mask is None:
-            # return names in sorted order of bitnum
-            bitnums = [x for x in self._bits.keys() if isinstance(x, int)]
-            for bitnum in sorted(bitnums):
-                names.append(self._bits[bitnum].name)
-        else:
-            mask = int(mask)    #- workaround numpy issue #2955 for uint64
-            bitnum = 0
-            while 2**bitnum <= mask:
-                if (2**bitnum & mask):
-                    if bitnum in self._bits.keys():
-                        names.append(self._bits[bitnum].name)
+            return [bit.name for bit in self._bitlist if bit is not None]
+        names = list()
+        if self.nwords > 1 and np.ndim(mask) > 0:
+            mask = _from_words(mask)
+        mask = int(mask)    #- workaround numpy issue #2955 for uint64
+        #
+        # Visit only the bits that are set, lowest first.
+        #
+        nbits = len(self._bitlist)
+        while mask > 0:
+            lowest = mask & -mask
+            bitnum = lowest.bit_length() - 1
+            if bitnum < nbits and self._bitlist[bitnum] is not None:
+                names.append(self._bitlist[bitnum].name)
+            else:
+                names.append('UNKNOWN' + str(bitnum))
+            mask ^= lowest
+        return names
+
+    def unique_names(self, mask):
+        """Return names of masked bits for each unique value of a mask array.
+
+        Only the unique values of `mask` are decoded, so this is much
+        faster than calling :meth:`names` on every element of a large
+        mask column.
+
+        Parameters
+        ----------
+        mask : :class:`~numpy.ndarray`
+            Integer mask array of any shape.
+
+        Returns
+        -------
+        :func:`tuple`
+            A tuple containing the sorted unique mask values, a list
+            of lists of names (one per unique value, as returned by
+            :meth:`names`) and an array of the same shape as `mask`
+            (without the word axis of multi-word masks) that
+            indexes the unique values.
+        """
+        mask = self._words(mask)
+        nwords = self.nwords
+        if nwords > 1:
+            values, inverse = np.unique(mask.reshape(-1, nwords), axis=0,
+                                        return_inverse=True)
+            names = [self.names(v) for v in values]
+            return values, names, inverse.reshape(mask.shape[:-1])
+        values, inverse = np.unique(mask.ravel(), return_inverse=True)
+        names = [self.names(int(v)) for v in values]
+        return values, names, inverse.reshape(mask.shape)
+
+    def to_strings(self, mask, sep='|', kind='U', categorical=False):
+        """Convert a mask array to strings of bit names, *e.g.* ``'BAD|HOT'``.
+
+        The string is built once per unique mask value, then broadcast
+        back to all elements.
+
+        Parameters
+        ----------
+        mask : :class:`~numpy.ndarray`
+            Integer mask array.
+        sep : :class:`str`, optional
+            Separator between bit names.
+        kind : :class:`str`, optional
+            'U' (default) for unicode or 'S' for bytes strings.
+        categorical : :class:`bool`, optional
+            If ``True``, return the strings of the unique values and
+            integer codes instead of the full string array.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray` or :func:`tuple`
+            Fixed-width string array of the same shape as `mask` (without
+            the word axis of multi-word masks), or, if `categorical` is
+            ``True``, a tuple of the array of unique strings and the array
+            of codes indexing it.
+        """
+        if kind not in ('U', 'S'):
+            raise ValueError("String kind must be 'U' or 'S', not '{0}'.".format(kind))
+        values, names, inverse = self.unique_names(mask)
+        labels = [sep.join(n) for n in names]
+        width = max([len(label) for label in labels] + [1])
+        labels = np.array(labels, dtype='{0}{1:d}'.format(kind, width))
+        if categorical:
+            return labels, inverse
+        return labels[inverse]
+
+    def from_strings(self, strings, sep='|'):
+        """Convert strings of bit names, *e.g.* ``'BAD|HOT'``, to a mask array.
+
+        Each unique string is parsed only once, and parsed strings are
+        cached for later calls.
+
+        Parameters
+        ----------
+        strings : :class:`~numpy.ndarray`
+            Array of unicode or bytes strings.
+        sep : :class:`str`, optional
+            Separator between bit names.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            Mask array of type :attr:`dtype`, with the shape of `strings`
+            (plus the word axis of multi-word masks).
+
+        Raises
+        ------
+        ValueError
+            If any unknown bit names are found; all of them are reported,
+            with the number of elements containing each one.
+        """
+        strings = np.asarray(strings)
+        if strings.dtype.kind not in ('U', 'S'):
+            raise ValueError("Input must be a string array, not {0}.".format(strings.dtype))
+        uniq, inverse = np.unique(strings.ravel(), return_inverse=True)
+        values = self.zeros(len(uniq))
+        unknown = OrderedDict()
+        counts = None
+        for i, string in enumerate(uniq):
+            if strings.dtype.kind == 'S':
+                string = string.decode('ascii')
+            key = (sep, string)
+            cached = self._strings_cache.get(key)
+            if cached is None:
+                bits = 0
+                missing = list()
+                for name in string.split(sep):
+                    name = name.strip()
+                    if name == '':
+                        continue
+                    if name in self._bits:
+                        bits |= self._bits[name].mask
                     else:
-                        names.append('UNKNOWN' + str(bitnum))
-                bitnum += 1
+                        missing.append(name)
+                cached = (bits, missing)
+                self._strings_cache[key] = cached
+            bits, missing = cached
+            if missing:
+                if counts is None:
+                    counts = np.bincount(inverse, minlength=len(uniq))
+                for name in missing:
+                    unknown[name] = unknown.get(name, 0) + int(counts[i])
+            elif self.nwords > 1:
+                values[i] = _to_words(bits, self.nwords)
+            else:
+                values[i] = bits
+        if unknown:
+            raise ValueError("Unknown bit names: " + ", ".join(
+                ["{0} ({1:d} elements)".format(name, n) for name, n in unknown.items()]))
+        return values[inverse].reshape(strings.shape + values.shape[1:])
 
-        return names
+    def bitarray(self, mask):
+        """Return a boolean array indicating which defined bits are set.
+
+        Parameters
+        ----------
+        mask : :class:`~numpy.ndarray`
+            Integer mask array of any shape.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            Boolean array of shape ``mask.shape + (nbits,)`` (replacing
+            the word axis of multi-word masks), where
+            ``nbits`` is the number of defined bits, in the same order
+            as :meth:`names`.  Bits that are set but not defined are ignored.
+        """
+        mask = self._words(mask)
+        if self.nwords > 1:
+            bitnums = np.array(self._bitnums)
+            bits = np.left_shift(np.uint64(1), (bitnums % 64).astype(np.uint64))
+            return (mask[..., bitnums // 64] & bits) != 0
+        bits = np.array([bit.mask for bit in self._bitlist if bit is not None],
+                        dtype=np.uint64)
+        values, inverse = np.unique(mask.ravel(), return_inverse=True)
+        table = (values.astype(np.uint64)[:, np.newaxis] & bits) != 0
+        return table[inverse].reshape(mask.shape + (len(bits),))
 
     def __getattr__(self, name):
         """Enable ``mask.BITNAME`` equivalent to ``mask['BITNAME']``.
         """
-        if name in self._bits:
-            return self._bits[name]
-        else:
+        #
+        # Look up _bits in __dict__ directly: during unpickling and copying
+        # this is called before __init__ has set any attributes.
+        #
+        try:
+            return self.__dict__['_bits'][name]
+        except KeyError:
             raise AttributeError('Unknown mask bit name ' + name)
 
     def __repr__(self):
@@ -261,9 +1566,9 @@ class BitMask(object):
         result = list()
         result.append(self._name + ':')
         # return names in sorted order of bitnum
-        bitnums = [x for x in self._bits.keys() if isinstance(x, int)]
-        for bitnum in sorted(bitnums):
-            bit = self._bits[bitnum]
+        for bit in self._bitlist:
+            if bit is None:
+                continue
             # format the line for single bit, with or without extra keys
             line = '  - [{:16s} {:2d}, "{}"'.format(
                 bit.name+',', bit.bitnum, bit.comment)
@@ -274,3 +1579,441 @@ class BitMask(object):
             result.append(line)
 
         return "\n".join(result)
+
+
+class FrozenBitMask(BitMask):
+    """Immutable, hashable :class:`BitMask`.
+
+    Frozen bitmasks compare equal if they have the same name and bit
+    definitions, so they can be used as cache keys.  They pickle to just
+    their name and bit definitions, so they are cheap to send to worker
+    processes.
+
+    The bit definitions, including extra values, are copied, and the
+    bits themselves cannot be modified, so changes to the original
+    definitions or :class:`BitMask` do not affect the frozen bitmask.
+
+    Parameters
+    ----------
+    name : :class:`str`
+        Name of this mask, must be key in `bitdefs`.
+    bitdefs : :class:`dict`
+        Dictionary of different mask bit definitions, as for :class:`BitMask`.
+    """
+
+    def __init__(self, name, bitdefs):
+        """Init.
+        """
+        super(FrozenBitMask, self).__init__(name, {name: deepcopy(bitdefs[name])})
+        for bit in self._bits.values():
+            bit.__dict__['_frozen'] = True
+        self._key = (name, tuple([(bit.name, bit.bitnum, bit.comment)
+                                  for bit in self._bitlist if bit is not None]))
+        #
+        # hash() of strings is salted per process, so derive the hash from
+        # a digest of the definitions, which is the same in every process.
+        #
+        digest = hashlib.sha1(json.dumps(self._key).encode('utf-8')).hexdigest()
+        self._hash = int(digest[:15], 16)
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_frozen', False):
+            raise AttributeError("FrozenBitMask objects are immutable.")
+        super(FrozenBitMask, self).__setattr__(name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError("FrozenBitMask objects are immutable.")
+
+    def define(self, name, expr):
+        """Not allowed, since frozen bitmasks are immutable.
+        """
+        raise TypeError("Cannot define expressions of a FrozenBitMask.")
+
+    def freeze(self):
+        """Return this bitmask, which is already frozen.
+        """
+        return self
+
+    def __reduce__(self):
+        return (FrozenBitMask, (self._name, self._bitdefs()))
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, FrozenBitMask):
+            return NotImplemented
+        return (self._hash == other._hash and self._key == other._key and
+                self._bitdefs() == other._bitdefs())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+class BitMaskIndex(object):
+    """Inverted index of the rows of a mask column that have each bit set.
+
+    Queries on the same static catalog are answered with set operations
+    on the sorted row numbers, without scanning the mask column again.
+
+    Parameters
+    ----------
+    mask : :class:`~numpy.ndarray`
+        One-dimensional integer mask column.
+    bitmask : :class:`BitMask`
+        The bit definitions of `mask`.
+
+    Examples
+    --------
+
+    >>> index = BitMaskIndex(data['CCDMASK'], ccdmask)
+    >>> index.query('(BAD|HOT)&~COSMIC')
+    array([ 3, 17, 52], dtype=int32)
+    >>> index.write('catalog-ccdmask-index.npz')
+    """
+
+    def __init__(self, mask, bitmask):
+        """Init.
+        """
+        mask = bitmask._words(mask)
+        if mask.ndim != (2 if bitmask.nwords > 1 else 1):
+            raise ValueError("Only one-dimensional mask columns can be indexed.")
+        self.bitmask = bitmask
+        self.nrows = mask.shape[0]
+        self._rows = dict()
+        for name in bitmask.names():
+            rows = np.flatnonzero(_anyset(mask, bitmask[name].mask,
+                                          bitmask.nwords))
+            self._rows[name] = self._freeze(rows.astype(self._dtype))
+
+    @staticmethod
+    def _freeze(rows):
+        """Make an index array read-only, since it may be shared.
+        """
+        rows.flags.writeable = False
+        return rows
+
+    @property
+    def _dtype(self):
+        """Integer type of the row numbers.
+        """
+        return np.int32 if self.nrows < 2**31 else np.int64
+
+    def rows(self, name):
+        """Return the sorted row numbers with a bit set.
+
+        Parameters
+        ----------
+        name : :class:`str` or :class:`int`
+            Bit name or number.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            Read-only array of row numbers.
+        """
+        return self._rows[self.bitmask[name].name]
+
+    def query(self, expr):
+        """Return the sorted row numbers matching a mask expression.
+
+        Parameters
+        ----------
+        expr : :class:`str`
+            Mask expression with the same meaning as in
+            :meth:`BitMask.predicate`, *e.g.* ``'(BAD|HOT)&~COSMIC'``.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            Array of row numbers.
+        """
+        return self._evaluate(self.bitmask._compile(expr))
+
+    def count(self, expr):
+        """Return the number of rows matching a mask expression.
+        """
+        return len(self.query(expr))
+
+    def union(self, *exprs):
+        """Return the rows matching any of the mask expressions.
+        """
+        rows = self.query(exprs[0])
+        for expr in exprs[1:]:
+            rows = np.union1d(rows, self.query(expr))
+        return rows
+
+    def intersection(self, *exprs):
+        """Return the rows matching all of the mask expressions.
+        """
+        rows = self.query(exprs[0])
+        for expr in exprs[1:]:
+            rows = np.intersect1d(rows, self.query(expr), assume_unique=True)
+        return rows
+
+    def difference(self, expr1, expr2):
+        """Return the rows matching `expr1` but not `expr2`.
+        """
+        return np.setdiff1d(self.query(expr1), self.query(expr2),
+                            assume_unique=True)
+
+    def _evaluate(self, node):
+        """Evaluate a parse tree as a sorted array of row numbers.
+        """
+        op = node[0]
+        if op == 'bit':
+            return self._rows[self.bitmask.bitname(node[1])]
+        elif op == 'not':
+            allrows = np.arange(self.nrows, dtype=self._dtype)
+            return np.setdiff1d(allrows, self._evaluate(node[1]),
+                                assume_unique=True)
+        rows = self._evaluate(node[1][0])
+        for child in node[1][1:]:
+            if op == 'or':
+                rows = np.union1d(rows, self._evaluate(child))
+            else:
+                rows = np.intersect1d(rows, self._evaluate(child),
+                                      assume_unique=True)
+        return rows
+
+    def write(self, filename):
+        """Write the index to a compressed :func:`numpy.savez` file.
+
+        Parameters
+        ----------
+        filename : :class:`str`
+            Output file name, usually next to the catalog.
+        """
+        arrays = dict(('rows_' + name, rows) for name, rows in self._rows.items())
+        np.savez_compressed(filename, nrows=self.nrows,
+                            name=self.bitmask._name,
+                            bitdefs=json.dumps(self.bitmask._bitdefs()),
+                            **arrays)
+
+    @classmethod
+    def read(cls, filename, bitmask=None):
+        """Read an index written by :meth:`write`.
+
+        Parameters
+        ----------
+        filename : :class:`str`
+            Input file name.
+        bitmask : :class:`BitMask`, optional
+            The bit definitions; if not given, they are reconstructed from
+            the definitions stored in the file.
+
+        Returns
+        -------
+        :class:`BitMaskIndex`
+            The index.
+        """
+        with np.load(filename) as f:
+            if bitmask is None:
+                bitmask = BitMask(str(f['name']),
+                                  json.loads(str(f['bitdefs'])))
+            index = cls.__new__(cls)
+            index.bitmask = bitmask
+            index.nrows = int(f['nrows'])
+            index._rows = dict()
+            for name in bitmask.names():
+                index._rows[name] = cls._freeze(f['rows_' + name])
+        return index
+
+
+class RunLengthMask(object):
+    """Run-length encoded mask image.
+
+    Pixel masks are mostly zero; they are stored as runs of identical
+    non-zero values along the flattened image.  The bitwise operations
+    ``|``, ``&`` and :meth:`andnot` work directly on the runs.
+
+    Parameters
+    ----------
+    shape : :func:`tuple`
+        Shape of the dense mask.
+    start : :class:`~numpy.ndarray`
+        Index of the first pixel of each run in the flattened mask.
+    length : :class:`~numpy.ndarray`
+        Number of pixels in each run.
+    value : :class:`~numpy.ndarray`
+        Mask value of each run.  The dtype of this array is also the
+        dtype of the dense mask.
+    bitmask : :class:`BitMask`, optional
+        The bit definitions of the mask values.
+
+    Examples
+    --------
+
+    >>> rle = RunLengthMask.from_dense(image_mask, ccdmask)
+    >>> combined = rle | RunLengthMask.from_dense(other_mask, ccdmask)
+    >>> combined.to_table().write('mask.fits')
+    """
+
+    def __init__(self, shape, start, length, value, bitmask=None):
+        """Init.
+        """
+        self.shape = tuple(shape)
+        self.start = np.asarray(start, dtype=np.int64)
+        self.length = np.asarray(length, dtype=np.int64)
+        self.value = np.asarray(value)
+        self.bitmask = bitmask
+
+    @property
+    def size(self):
+        """Number of pixels in the dense mask.
+        """
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the runs.
+        """
+        return self.start.nbytes + self.length.nbytes + self.value.nbytes
+
+    def __len__(self):
+        return len(self.start)
+
+    @classmethod
+    def from_dense(cls, mask, bitmask=None):
+        """Encode a dense mask array.
+
+        Parameters
+        ----------
+        mask : :class:`~numpy.ndarray`
+            Integer mask array.
+        bitmask : :class:`BitMask`, optional
+            The bit definitions of `mask`.
+
+        Returns
+        -------
+        :class:`RunLengthMask`
+            The encoded mask.
+        """
+        mask = np.asarray(mask)
+        flat = mask.ravel()
+        if flat.dtype.kind not in 'iu':
+            raise ValueError("Mask arrays must have an integer dtype, " +
+                             "not {0}.".format(flat.dtype))
+        edges = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        start = np.concatenate(([0], edges)) if flat.size > 0 else edges
+        end = np.concatenate((edges, [flat.size])) if flat.size > 0 else edges
+        value = flat[start]
+        keep = value != 0
+        return cls(mask.shape, start[keep], (end - start)[keep], value[keep],
+                   bitmask=bitmask)
+
+    def to_dense(self):
+        """Decode to a dense mask array.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            The mask, with the shape and dtype of the original mask.
+        """
+        flat = np.zeros(self.size, dtype=self.value.dtype)
+        offset = np.repeat(self.start - np.cumsum(self.length) + self.length,
+                           self.length)
+        flat[np.arange(len(offset)) + offset] = np.repeat(self.value, self.length)
+        return flat.reshape(self.shape)
+
+    def _values_at(self, pixels):
+        """Return the mask values at the flattened pixel indices `pixels`.
+        """
+        if len(self) == 0:
+            return np.zeros(len(pixels), dtype=self.value.dtype)
+        i = np.searchsorted(self.start, pixels, side='right') - 1
+        j = np.maximum(i, 0)
+        inside = (i >= 0) & (pixels < self.start[j] + self.length[j])
+        return np.where(inside, self.value[j], 0).astype(self.value.dtype)
+
+    def _combine(self, other, op):
+        """Combine two run-length masks with the bitwise function `op`.
+        """
+        if not isinstance(other, RunLengthMask):
+            return NotImplemented
+        if self.shape != other.shape:
+            raise ValueError("Masks have different shapes: {0} != {1}.".format(
+                self.shape, other.shape))
+        #
+        # Both masks are constant between consecutive run boundaries.
+        #
+        bounds = np.union1d(np.concatenate((self.start, self.start + self.length)),
+                            np.concatenate((other.start, other.start + other.length)))
+        start, end = bounds[:-1], bounds[1:]
+        dtype = np.promote_types(self.value.dtype, other.value.dtype)
+        value = op(self._values_at(start).astype(dtype),
+                   other._values_at(start).astype(dtype))
+        keep = value != 0
+        start, end, value = start[keep], end[keep], value[keep]
+        #
+        # Merge touching segments with the same value.
+        #
+        first = np.ones(len(start), dtype=bool)
+        first[1:] = (start[1:] != end[:-1]) | (value[1:] != value[:-1])
+        ifirst = np.flatnonzero(first)
+        if len(ifirst) > 0:
+            ilast = np.concatenate((ifirst[1:] - 1, [len(start) - 1]))
+        else:
+            ilast = ifirst
+        bitmask = self.bitmask if self.bitmask is not None else other.bitmask
+        return RunLengthMask(self.shape, start[ifirst],
+                             end[ilast] - start[ifirst], value[ifirst],
+                             bitmask=bitmask)
+
+    def __or__(self, other):
+        return self._combine(other, np.bitwise_or)
+
+    def __and__(self, other):
+        return self._combine(other, np.bitwise_and)
+
+    def andnot(self, other):
+        """Return the bits set in this mask but not in `other`.
+        """
+        return self._combine(other, lambda a, b: a & ~b)
+
+    def to_table(self):
+        """Convert to a table suitable for a FITS binary table HDU.
+
+        Returns
+        -------
+        :class:`~astropy.table.Table`
+            Table with columns ``START``, ``LENGTH`` and ``VALUE``; the
+            shape of the mask is stored in the ``RLESHAPE`` keyword and
+            the bit definitions, if any, as in :meth:`BitMask.to_header`.
+        """
+        from astropy.table import Table
+        table = Table()
+        table['START'] = self.start
+        table['LENGTH'] = self.length
+        table['VALUE'] = self.value
+        table.meta['RLESHAPE'] = ','.join([str(n) for n in self.shape])
+        if self.bitmask is not None:
+            self.bitmask.to_header(table.meta)
+        return table
+
+    @classmethod
+    def from_table(cls, table, bitmask=None):
+        """Convert a table written by :meth:`to_table`.
+
+        Parameters
+        ----------
+        table : :class:`~astropy.table.Table`
+            The table.
+        bitmask : :class:`BitMask`, optional
+            The bit definitions of the mask.  If not given, they are
+            read from the table metadata, if present.
+
+        Returns
+        -------
+        :class:`RunLengthMask`
+            The mask.
+        """
+        if bitmask is None and 'BMNAME' in table.meta:
+            bitmask = BitMask.from_header(table.meta)
+        shape = tuple([int(n) for n in table.meta['RLESHAPE'].split(',')])
+        return cls(shape, np.asarray(table['START']), np.asarray(table['LENGTH']),
+                   np.asarray(table['VALUE']), bitmask=bitmask)
@@ -96,12 +96,22 @@ def func_val(x, fit_dict):
 
 def iter_fit(xarray, yarray, func, order, weights=None, sigma=None,
              max_rej=None, maxone=True, sig_rej=3.0, initialmask=None,
-             forceimask=False, xmin=None, xmax=None, niter=999, **kwargs):
+             forceimask=False, xmin=None, xmax=None, niter=999,
+             method='reject', tune=None, tol=1e-6, return_weights=False,
+             **kwargs):
     """A "robust" fit with iterative rejection is performed to the
     `xarray`, `yarray` pairs.
 
     Modified code originally from Ryan Cooke (PYPIT).
 
+    With ``method='huber'`` or ``method='tukey'`` the hard rejection loop
+    is replaced by iteratively reweighted least squares (IRLS) using the
+    corresponding robust loss function.  This usually converges in a
+    handful of fits, instead of one fit per rejected point.  The IRLS
+    methods do not reject points one at a time, so `max_rej`, `maxone`
+    and `forceimask` do not apply to them (`initialmask` is always
+    enforced); a warning is issued if they are set.
+
     Parameters
     ----------
     xarray : :class:`~numpy.ndarray`
@@ -130,6 +140,17 @@ def iter_fit(xarray, yarray, func, order, weights=None, sigma=None,
         If ``True``, the initialmask will be forced for all iterations.
     niter : :class:`int`, optional [999]
         Maximum number of iterations.
+    method : :class:`str`, optional ['reject']
+        Robust fitting method: 'reject' (iterative sigma rejection),
+        'huber' or 'tukey' (IRLS with Huber or Tukey biweight loss).
+    tune : :class:`float`, optional
+        Tuning constant of the IRLS loss function, in units of the
+        residual scale.  Defaults to 1.345 for 'huber' and 4.685 for 'tukey'.
+    tol : :class:`float`, optional [1e-6]
+        IRLS convergence tolerance on the change of the robust weights.
+    return_weights : :class:`bool`, optional [False]
+        If ``True``, also return the weight (0 to 1) of each point in
+        the final fit.
     xmin : :class:`float`
         Minimum value in the array (or the left limit for a
         legendre/chebyshev polynomial).
@@ -141,8 +162,24 @@ def iter_fit(xarray, yarray, func, order, weights=None, sigma=None,
     -------
     :func:`tuple`
         The tuple contains a dict containing the fit and a mask array
-        containing masked values.
+        containing masked values.  If `return_weights` is ``True`` the
+        tuple has a third element, an array containing the weights of
+        each point in the final fit: the robust weights for the IRLS
+        methods, 1 for unmasked and 0 for masked points otherwise.
     """
+    if method != 'reject':
+        if max_rej is not None or not maxone or forceimask:
+            warnings.warn("max_rej, maxone and forceimask are ignored by " +
+                          "method='{0}'".format(method))
+        fdict, mask, rweight = _irls_fit(xarray, yarray, func, order, method,
+                                         weights=weights, sigma=sigma,
+                                         sig_rej=sig_rej,
+                                         initialmask=initialmask,
+                                         xmin=xmin, xmax=xmax, niter=niter,
+                                         tune=tune, tol=tol, **kwargs)
+        if return_weights:
+            return fdict, mask, rweight
+        return fdict, mask
     # Setup the initial mask
     if initialmask is None:
         mask = np.zeros(xarray.size, dtype=np.int)
@@ -217,9 +254,84 @@ def iter_fit(xarray, yarray, func, order, weights=None, sigma=None,
     xfit = xarray[w]
     yfit = yarray[w]
     fdict = func_fit(xfit, yfit, func, order, xmin=xmin, xmax=xmax, **kwargs)
+    if return_weights:
+        return fdict, mask, (mask == 0).astype(float)
     return fdict, mask
 
 
+def _irls_fit(xarray, yarray, func, order, method, weights=None, sigma=None,
+              sig_rej=3.0, initialmask=None, xmin=None, xmax=None, niter=999,
+              tune=None, tol=1e-6, **kwargs):
+    """Iteratively reweighted least squares fit with a robust loss function.
+
+    See :func:`iter_fit` for the description of the parameters.
+
+    Returns
+    -------
+    :func:`tuple`
+        The fit dict, the mask array (1 = masked or more than `sig_rej`
+        from the fit) and the array of robust weights.
+    """
+    tunes = {'huber': 1.345, 'tukey': 4.685}
+    try:
+        c = tunes[method] if tune is None else tune
+    except KeyError:
+        raise ValueError("Fitting method '{0:s}' is not implemented yet.".format(method))
+    # Setup the initial mask; these points get zero weight throughout
+    if initialmask is None:
+        mask = np.zeros(xarray.size, dtype=int)
+    else:
+        mask = initialmask.copy()
+    if weights is not None:
+        mask[weights <= 0.] = 1
+        wbase = np.where(mask == 0, weights, 0.)
+    else:
+        wbase = np.where(mask == 0, 1., 0.)
+    good = mask == 0
+    if good.sum() <= order+2:
+        warnings.warn("More parameters than data points - fit might be undesirable")
+    # Fix the normalization to the full range, so that all fits agree
+    if xmin is None or xmax is None:
+        xmin, xmax = xarray[good].min(), xarray[good].max()
+    rweight = good.astype(float)
+    iiter = 0
+    while True:
+        iiter += 1
+        dfit = func_fit(xarray, yarray, func, order, xmin=xmin, xmax=xmax,
+                        w=wbase*np.sqrt(rweight), **kwargs)
+        resid = yarray - func_val(xarray, dfit)
+        if sigma is not None:
+            u = resid/sigma
+        else:
+            scale = 1.4826*np.median(np.abs(resid[good]))
+            if scale == 0:
+                break   # Exact fit to at least half the points
+            u = resid/scale
+        au = np.abs(u)/c
+        if method == 'huber':
+            neww = np.minimum(1.0, 1.0/np.maximum(au, 1e-30))
+        else:
+            neww = np.where(au < 1.0, (1.0 - au**2)**2, 0.)
+        neww[~good] = 0.
+        delta = np.max(np.abs(neww - rweight))
+        rweight = neww
+        if delta < tol:
+            break
+        if iiter >= niter:
+            warnings.warn("Reached maximum number of iterations")
+            break
+    # Final fit with the converged weights
+    dfit = func_fit(xarray, yarray, func, order, xmin=xmin, xmax=xmax,
+                    w=wbase*np.sqrt(rweight), **kwargs)
+    resid = yarray - func_val(xarray, dfit)
+    if sigma is not None:
+        mask[np.abs(resid) > sig_rej*sigma] = 1
+    else:
+        sigmed = 1.4826*np.median(np.abs(resid[good]))
+        mask[np.abs(resid) > sig_rej*sigmed] = 1
+    return dfit, mask, rweight
+
+
 def mk_fit_dict(coeff, order, func, xmin=None, xmax=None, **kwargs):
     """Generate a dict that is formatted for using func_val.
 
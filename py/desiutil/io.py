@@ -140,7 +140,176 @@ use encoding=None to use data.metadata['ENCODING'] instead""".format(\
 
     return encoding
 
-def encode_table(data, encoding='ascii'):
+def _codepoint_limit(encoding):
+    '''
+    Return the code point limit below which `encoding` maps each unicode
+    character to the single byte of the same value, or None if there is
+    no such range.
+
+    Args:
+        encoding : (str) name of the encoding
+    '''
+    import codecs
+    name = codecs.lookup(encoding).name
+    if name in ('ascii', 'utf-8'):
+        return 128
+    elif name == 'iso8859-1':
+        return 256
+    return None
+
+def _encode_column(column, encoding, shrink=False):
+    '''
+    Encode a unicode column into bytes.
+
+    If every code point is below the limit of `encoding` (see
+    `_codepoint_limit`) the code points are cast directly to bytes,
+    without encoding each element; otherwise use numpy.char.encode.
+
+    Args:
+        column : unicode numpy array or Column
+        encoding : (str) encoding to use
+
+    Options:
+        shrink : if True, return the narrowest bytes width that holds
+            every encoded value instead of the width of `column`
+
+    Returns bytes numpy array of the same shape and, unless `shrink`,
+    the same width
+    '''
+    import numpy as np
+    column = np.asarray(column)
+    n = _dtype_size(column.dtype)
+    limit = _codepoint_limit(encoding)
+    if limit is not None and n > 0:
+        native = np.ascontiguousarray(column, dtype='U{}'.format(n))
+        codes = native.view(np.uint32).reshape(column.shape + (n,))
+        if codes.size == 0 or codes.max() < limit:
+            if shrink:
+                #- Trailing characters that are NUL in every row are padding
+                used = np.flatnonzero(codes.reshape(-1, n).any(axis=0))
+                n = used[-1] + 1 if len(used) > 0 else 1
+                codes = codes[..., :n]
+            return codes.astype(np.uint8).view('S{}'.format(n)).reshape(column.shape)
+    encoded = np.char.encode(column, encoding=encoding)
+    if shrink:
+        #- numpy.char.encode already picks the widest encoded value
+        return encoded.astype('S{}'.format(max(encoded.dtype.itemsize, 1)))
+    return encoded.astype('S{}'.format(n))
+
+def _decode_column(column, encoding):
+    '''
+    Decode a bytes column into unicode.
+
+    If every byte is below the limit of `encoding` (see `_codepoint_limit`),
+    i.e. the high bit is clear for ASCII, the bytes are widened directly
+    into code points; otherwise use numpy.char.decode.
+
+    Args:
+        column : bytes numpy array or Column
+        encoding : (str) encoding to use
+
+    Returns unicode numpy array of the same shape and width
+    '''
+    import numpy as np
+    column = np.asarray(column)
+    n = _dtype_size(column.dtype)
+    limit = _codepoint_limit(encoding)
+    if limit is not None and n > 0:
+        octets = np.ascontiguousarray(column).view(np.uint8).reshape(column.shape + (n,))
+        if octets.size == 0 or octets.max() < limit:
+            return octets.astype(np.uint32).view('U{}'.format(n)).reshape(column.shape)
+    return np.char.decode(column, encoding=encoding).astype('U{}'.format(n))
+
+def _as_table(data, inplace=False):
+    '''
+    Wrap `data` in an astropy Table for encode_table / decode_table
+
+    Args:
+        data : numpy structured array or astropy Table
+
+    Options:
+        inplace : if True, `data` must already be an astropy Table and is
+            returned as-is so that its columns can be replaced in place
+
+    Raises:
+        ValueError if inplace is True and `data` is not an astropy Table
+    '''
+    from astropy.table import Table
+    if inplace:
+        if not isinstance(data, Table):
+            raise ValueError('inplace=True requires an astropy Table, not {}'.format(
+                type(data).__name__))
+        return data
+
+    try:
+        return Table(data, copy=False)
+    except ValueError:  #- https://github.com/astropy/astropy/issues/5298
+        return Table(data, copy=True)
+
+def _string_columns(table, kind, columns=None):
+    '''
+    Return names of the columns of `table` with dtype.kind == `kind`
+
+    Args:
+        table : astropy Table object
+        kind : 'U' for unicode or 'S' for bytes columns
+
+    Options:
+        columns : list of column names to consider; default all columns
+
+    Raises:
+        KeyError if a requested column is not in `table`
+    '''
+    if columns is None:
+        columns = table.colnames
+    elif isinstance(columns, basestring):
+        columns = [columns, ]
+    missing = [c for c in columns if c not in table.colnames]
+    if missing:
+        raise KeyError('Columns not in table: {}'.format(', '.join(missing)))
+    return [c for c in columns if table[c].dtype.kind == kind]
+
+def _convert_columns(table, colnames, convert, encoding, workers=1):
+    '''
+    Replace columns of `table` with ``convert(column, encoding)``
+
+    Args:
+        table : astropy Table object
+        colnames : list of names of the columns to convert
+        convert : `_encode_column` or `_decode_column`
+        encoding : (str) encoding to use
+
+    Options:
+        workers : number of threads used to convert columns concurrently;
+            default 1 converts the columns serially
+
+    Columns are replaced in order as soon as they are converted, so the
+    result does not depend on `workers`.
+    '''
+    if workers > 1 and len(colnames) > 1:
+        from multiprocessing.pool import ThreadPool
+        #- Fetch columns up front: the table is modified while threads run.
+        #- Each thread drops its reference so replaced columns can be freed.
+        columns = [table[col] for col in colnames]
+
+        def work(i):
+            column = columns[i]
+            columns[i] = None
+            return convert(column, encoding)
+
+        pool = ThreadPool(min(workers, len(colnames)))
+        try:
+            for col, column in zip(colnames, pool.imap(work, range(len(colnames)))):
+                table.replace_column(col, column)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for col in colnames:
+            table.replace_column(col, convert(table[col], encoding))
+
+def encode_table(data, encoding='ascii', inplace=False, columns=None,
+                 workers=1, shrink=False):
     '''
     Encode unicode strings in a table into bytes using numpy.char.encode
 
@@ -151,37 +320,67 @@ def encode_table(data, encoding='ascii'):
         encoding : encoding to use for converting unicode to bytes.
             Default 'ascii' (FITS and HDF5 friendly), but if None,
             use ENCODING from table metadata if available
+        inplace : if True, `data` must be an astropy Table whose columns
+            are replaced in place; no copy of the table is made
+        columns : list of column names to convert; default all unicode
+            columns.  Non-unicode columns in the list are left unchanged.
+        workers : number of threads used to convert columns concurrently;
+            default 1.  The result is identical for any number of workers.
+        shrink : if True, give each converted column the narrowest bytes
+            width that holds its longest encoded value, instead of the
+            width of the unicode column; the number of bytes saved is
+            logged at INFO level
 
     Returns astropy Table with unicode columns converted to bytes
 
+    Columns are converted and replaced one at a time, so peak memory is
+    only one converted column (one per worker) above the input table.
+
+    Columns that only contain ASCII characters (or latin-1 characters
+    for the latin-1 encoding) are converted with a direct cast of the
+    code points, which is much faster than numpy.char.encode.
+
     Raises:
         UnicodeEncodeError if any input strings cannot be encoded using
             the specified encoding
         UnicodeError if no encoding is given as argument or in table metadata
+        ValueError if inplace is True and `data` is not an astropy Table
+        KeyError if `columns` includes a column not in `data`
 
     Note: `encoding` option overides data.meta['ENCODING'];
         use encoding=None to use data.meta['ENCODING'] instead
     '''
-    from astropy.table import Table
-    import numpy as np
-
-    try:
-        table = Table(data, copy=False)
-    except ValueError:  #- https://github.com/astropy/astropy/issues/5298
-        table = Table(data, copy=True)
-
+    table = _as_table(data, inplace=inplace)
     encoding = _pick_encoding(table, encoding)
 
-    for col in table.colnames:
-        dtype = table[col].dtype
-        if dtype.kind == 'U':
-            Sn = 'S{}'.format(_dtype_size(dtype))
-            table.replace_column(col, np.char.encode(table[col], encoding=encoding).astype(Sn))
+    colnames = _string_columns(table, 'U', columns)
+    if shrink:
+        import logging
+        log = logging.getLogger(__name__ + '.encode_table')
+        widths = dict((col, _dtype_size(table[col].dtype)) for col in colnames)
+        convert = lambda column, encoding: _encode_column(column, encoding,
+                                                          shrink=True)
+    else:
+        convert = _encode_column
+
+    _convert_columns(table, colnames, convert, encoding, workers=workers)
+
+    if shrink:
+        saved = 0
+        for col in colnames:
+            width = table[col].dtype.itemsize
+            nbytes = table[col].size * (widths[col] - width)
+            log.debug('Column {0}: U{1} -> S{2}, saved {3:d} bytes.'.format(
+                col, widths[col], width, nbytes))
+            saved += nbytes
+        log.info('Shrinking {0:d} string columns saved {1:d} bytes.'.format(
+            len(colnames), saved))
 
     table.meta['ENCODING'] = encoding
     return table
 
-def decode_table(data, encoding='ascii', native=True):
+def decode_table(data, encoding='ascii', native=True, inplace=False,
+                 columns=None, workers=1):
     '''
     Decode byte strings in a table into unicode strings
 
@@ -193,27 +392,475 @@ def decode_table(data, encoding='ascii', native=True):
             default 'ascii'; if None, try ENCODING keyword in data instead
         native : if True (default), only decode if native str type is unicode
             (i.e. python3 but not python2)
+        inplace : if True, `data` must be an astropy Table whose columns
+            are replaced in place; no copy of the table is made
+        columns : list of column names to convert; default all bytes
+            columns.  Non-bytes columns in the list are left unchanged.
+        workers : number of threads used to convert columns concurrently;
+            default 1.  The result is identical for any number of workers.
+
+    Columns are converted and replaced one at a time, so peak memory is
+    only one converted column (one per worker) above the input table.
+
+    Columns that only contain ASCII bytes (any bytes for latin-1) are
+    widened directly into code points, which is much faster than
+    numpy.char.decode.
 
     Note: `encoding` option overides data.meta['ENCODING'];
         use encoding=None to use data.meta['ENCODING'] instead
     '''
-    from astropy.table import Table
     import numpy as np
-    try:
-        table = Table(data, copy=False)
-    except ValueError:  #- https://github.com/astropy/astropy/issues/5298
-        table = Table(data, copy=True)
+    table = _as_table(data, inplace=inplace)
 
     #- Check if native str type is bytes
     if native and np.str_('a').dtype.kind == 'S':
         return table
 
     encoding = _pick_encoding(table, encoding)
-    for col in table.colnames:
-        dtype = table[col].dtype
-        if dtype.kind == 'S':
-            Un = 'U{}'.format(_dtype_size(dtype))
-            table.replace_column(col, np.char.decode(table[col], encoding=encoding).astype(Un))
+    _convert_columns(table, _string_columns(table, 'S', columns),
+                     _decode_column, encoding, workers=workers)
 
     table.meta['ENCODING'] = encoding
     return table
+
+def iter_table_blocks(filename, ext=1, rows=100000, decode=True,
+                      encoding='ascii'):
+    '''
+    Iterate over blocks of rows of a FITS binary table
+
+    Args:
+        filename : FITS file name
+
+    Options:
+        ext : HDU number or name of the binary table; default 1
+        rows : maximum number of rows per block
+        decode : if True (default), decode bytes columns of each block
+            into unicode with `decode_table`
+        encoding : encoding to use for decoding; default 'ascii'
+
+    Yields astropy Tables of at most `rows` rows.  The file is memory-mapped
+    and only one block is copied into memory at a time, so tables larger
+    than memory can be processed; see also `write_table_blocks`.
+
+    The meta of each block holds the header keywords of the table, except
+    for the structural and column keywords and checksums, as with
+    ``Table.read``.
+    '''
+    from copy import deepcopy
+    import numpy as np
+    from astropy.io import fits
+    from astropy.table import Table
+    if rows < 1:
+        raise ValueError('rows must be positive, not {}'.format(rows))
+
+    with fits.open(filename, memmap=True) as hdus:
+        data = hdus[ext].data
+        meta = _header_meta(hdus[ext].header)
+        nrows = 0 if data is None else len(data)
+        for start in range(0, nrows, rows):
+            #- Take bytes columns from the raw records, since FITS_rec
+            #- fields of a slice are always converted to unicode.
+            rec = data[start:start+rows]
+            raw = rec.view(np.ndarray)
+            names = raw.dtype.names
+            block = Table([np.array(raw[name] if raw.dtype[name].kind == 'S'
+                                    else rec[name]) for name in names],
+                          names=names, meta=deepcopy(meta), copy=False)
+            if decode:
+                decode_table(block, encoding=encoding, inplace=True)
+            yield block
+
+def _header_meta(header):
+    '''
+    Return table metadata from the keywords of a binary table header
+
+    Structural and column keywords are skipped, as are CHECKSUM and
+    DATASUM, which are not valid for a new file; COMMENT and HISTORY
+    cards are collected into lists, stored in 'comments' and 'HISTORY' as
+    by ``Table.read``.
+
+    Args:
+        header : astropy.io.fits.Header of a binary table HDU
+    '''
+    from collections import OrderedDict
+    from astropy.io.fits.connect import REMOVE_KEYWORDS, is_column_keyword
+    meta = OrderedDict()
+    for key, value in header.items():
+        if key in ('COMMENT', 'HISTORY'):
+            key = 'comments' if key == 'COMMENT' else key
+            meta.setdefault(key, []).append(value)
+        elif (key in REMOVE_KEYWORDS or key in ('CHECKSUM', 'DATASUM') or
+              is_column_keyword(key)):
+            continue
+        else:
+            meta[key] = value
+    return meta
+
+def _table_layout(header):
+    '''
+    Return the column layout keywords of a binary table header, used to
+    check that all blocks written by `write_table_blocks` are compatible
+    '''
+    layout = [header['NAXIS1']]
+    for i in range(1, header['TFIELDS']+1):
+        layout.append(tuple(header.get(key + str(i))
+                            for key in ('TTYPE', 'TFORM', 'TDIM')))
+    return layout
+
+def write_table_blocks(filename, blocks, encoding='ascii', extname=None,
+                       overwrite=False):
+    '''
+    Write blocks of rows to a FITS binary table, one block at a time
+
+    Args:
+        filename : output FITS file name
+        blocks : iterable of numpy structured arrays or astropy Tables,
+            all with the same columns, e.g. from `iter_table_blocks`
+
+    Options:
+        encoding : encoding to use for converting unicode columns to
+            bytes with `encode_table`; default 'ascii'
+        extname : EXTNAME of the binary table HDU; default the EXTNAME
+            in the meta of the first block, if any
+        overwrite : if True, overwrite an existing `filename`
+
+    Returns the total number of rows written.
+
+    The header is taken from the first block, including the keywords in
+    its meta; each block is encoded and appended to the file as soon as it
+    is received, so only one block is held in memory at a time.  Bytes
+    columns of later blocks may be narrower than in the first block, but
+    not wider.
+
+    The table is written to a temporary file that is renamed to `filename`
+    once complete, so that errors never leave a truncated file behind or
+    replace an existing one.
+
+    Raises:
+        IOError if `filename` exists and `overwrite` is False
+        ValueError if there are no blocks, or the blocks have incompatible
+            columns or variable length array columns
+    '''
+    import os
+    from io import BytesIO
+    from astropy.io import fits
+    if os.path.exists(filename) and not overwrite:
+        raise IOError('{} already exists'.format(filename))
+
+    nrows = 0
+    layout = None
+    tmpfile = '{0}.tmp{1:d}'.format(filename, os.getpid())
+    try:
+        with open(tmpfile, 'wb') as fx:
+            for block in blocks:
+                table = encode_table(block, encoding=encoding)
+                if layout is not None:
+                    for col in _string_columns(table, 'S'):
+                        if col in dtypes and table[col].dtype != dtypes[col]:
+                            if table[col].dtype.itemsize > dtypes[col].itemsize:
+                                raise ValueError('column {} is wider than in the '
+                                                 'first block'.format(col))
+                            table.replace_column(col, table[col].astype(dtypes[col]))
+                hdu = fits.BinTableHDU(table, name=extname)
+                if layout is None:
+                    if hdu.header['PCOUNT'] != 0:
+                        raise ValueError('variable length array columns are not supported')
+                    layout = _table_layout(hdu.header)
+                    dtypes = dict((col, table[col].dtype) for col in table.colnames)
+                    header = hdu.header.copy()
+                    fx.write(fits.PrimaryHDU().header.tostring().encode('ascii'))
+                    header_offset = fx.tell()
+                    fx.write(header.tostring().encode('ascii'))
+                elif _table_layout(hdu.header) != layout:
+                    raise ValueError('block columns do not match the first block')
+
+                nbytes = hdu.header['NAXIS1'] * hdu.header['NAXIS2']
+                if nbytes > 0:
+                    buf = BytesIO()
+                    hdu.writeto(buf)
+                    raw = buf.getvalue()
+                    padded = nbytes + (-nbytes % 2880)
+                    start = len(raw) - padded
+                    fx.write(raw[start:start+nbytes])
+                nrows += len(table)
+
+            if layout is None:
+                raise ValueError('no blocks to write to {}'.format(filename))
+
+            #- Pad the data and rewrite the header with the final row count
+            fx.write(b'\0' * (-(fx.tell() - header_offset) % 2880))
+            header['NAXIS2'] = nrows
+            fx.seek(header_offset)
+            fx.write(header.tostring().encode('ascii'))
+        os.rename(tmpfile, filename)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+    return nrows
+
+def _categorical_slots(meta):
+    '''
+    Return dict mapping column name to keyword slot number of the
+    categorical columns described in `meta`
+    '''
+    slots = dict()
+    i = 0
+    while 'CATCOL{0:02d}'.format(i) in meta:
+        slots[meta['CATCOL{0:02d}'.format(i)]] = i
+        i += 1
+    return slots
+
+def get_categories(meta, colname):
+    '''
+    Return the list of values of a categorical column
+
+    Args:
+        meta : table metadata or FITS header written by `encode_categorical`
+        colname : name of the categorical column
+
+    Returns list of unicode strings; code `i` of column `colname`
+    stands for the `i`-th value.
+
+    Raises:
+        KeyError if `colname` is not a categorical column
+    '''
+    slots = _categorical_slots(meta)
+    if colname not in slots:
+        raise KeyError('{} is not a categorical column'.format(colname))
+    i = slots[colname]
+    n = meta['CATNUM{0:02d}'.format(i)]
+    return [meta['C{0:02d}V{1:03d}'.format(i, j)] for j in range(n)]
+
+def encode_categorical(data, columns, encoding='ascii', inplace=False,
+                       maxvalues=1000):
+    '''
+    Replace low-cardinality string columns by integer codes
+
+    Args:
+        data : numpy structured array or astropy Table
+        columns : list of names of the string columns to encode, e.g.
+            ['OBJTYPE', 'SPECTYPE']; non-string columns are left unchanged
+
+    Options:
+        encoding : encoding used to decode the values of bytes columns
+            for the metadata; default 'ascii'
+        inplace : if True, `data` must be an astropy Table whose columns
+            are replaced in place
+        maxvalues : maximum number of distinct values in a column (at most
+            1000, the number of keywords available per column)
+
+    Returns astropy Table with each encoded column replaced by codes of the
+    smallest unsigned integer type that holds them.  The values are stored
+    in table.meta, which is written to the FITS header: keyword CATCOLnn
+    holds the column name, CATNUMnn the number of values and CnnVmmm the
+    value of code mmm.  Codes follow the sorted order of the values.
+
+    Use `decode_categorical` to convert the codes back to strings, or
+    `get_categories` to look up the values, e.g. to filter on the codes.
+
+    Raises:
+        ValueError if a requested column has more than `maxvalues`
+            distinct values or if more than 100 columns are encoded
+        KeyError if `columns` includes a column not in `data`
+    '''
+    import numpy as np
+    if maxvalues > 1000:
+        raise ValueError('maxvalues must be at most 1000, not {}'.format(maxvalues))
+    table = _as_table(data, inplace=inplace)
+    slots = _categorical_slots(table.meta)
+    if isinstance(columns, basestring):
+        columns = [columns, ]
+    colnames = _string_columns(table, 'U', columns) + \
+               _string_columns(table, 'S', columns)
+    colnames = [c for c in columns if c in colnames]
+
+    for col in colnames:
+        column = np.asarray(table[col])
+        values, codes = np.unique(column, return_inverse=True)
+        if len(values) > maxvalues:
+            raise ValueError('Column {} has {} distinct values, more than {}'.format(
+                col, len(values), maxvalues))
+        if column.dtype.kind == 'S':
+            values = [v.decode(encoding) for v in values]
+        else:
+            values = values.tolist()
+        if col in slots:
+            i = slots[col]
+        else:
+            i = len(slots)
+            if i > 99:
+                raise ValueError('Too many categorical columns')
+            slots[col] = i
+        for j in range(len(values)):
+            table.meta['C{0:02d}V{1:03d}'.format(i, j)] = values[j]
+        j = len(values)
+        while 'C{0:02d}V{1:03d}'.format(i, j) in table.meta:
+            del table.meta['C{0:02d}V{1:03d}'.format(i, j)]
+            j += 1
+        table.meta['CATCOL{0:02d}'.format(i)] = col
+        table.meta['CATNUM{0:02d}'.format(i)] = len(values)
+        dtype = np.min_scalar_type(max(len(values) - 1, 0))
+        table.replace_column(col, codes.astype(dtype).reshape(column.shape))
+
+    return table
+
+def decode_categorical(data, columns=None, inplace=False):
+    '''
+    Convert categorical columns written by `encode_categorical` to strings
+
+    Args:
+        data : astropy Table with categorical metadata, or numpy structured
+            array with a `meta` attribute
+
+    Options:
+        columns : list of categorical column names to decode;
+            default all categorical columns
+        inplace : if True, `data` must be an astropy Table whose columns
+            are replaced in place
+
+    Returns astropy Table with the codes replaced by unicode strings; the
+    categorical keywords of the decoded columns are removed from table.meta.
+
+    Raises:
+        KeyError if `columns` includes a column that is not categorical;
+            the table is not changed
+    '''
+    import numpy as np
+    table = _as_table(data, inplace=inplace)
+    slots = _categorical_slots(table.meta)
+    if columns is None:
+        columns = [c for c in table.colnames if c in slots]
+    elif isinstance(columns, basestring):
+        columns = [columns, ]
+    #- Check all names first, so that errors leave the table unchanged
+    missing = [c for c in columns if c not in slots]
+    if missing:
+        raise KeyError('Not categorical columns: {}'.format(', '.join(missing)))
+
+    for col in columns:
+        values = np.array(get_categories(table.meta, col), dtype=str)
+        if len(values) == 0:
+            values = np.zeros(0, dtype='U1')
+        table.replace_column(col, values[np.asarray(table[col])])
+
+    #- Rewrite the keywords of the remaining categorical columns
+    remaining = [(slots[c], c) for c in slots if c not in columns]
+    remaining = [(c, get_categories(table.meta, c)) for i, c in sorted(remaining)]
+    for i in range(len(slots)):
+        n = table.meta.pop('CATNUM{0:02d}'.format(i))
+        del table.meta['CATCOL{0:02d}'.format(i)]
+        for j in range(n):
+            del table.meta['C{0:02d}V{1:03d}'.format(i, j)]
+    for i, (col, values) in enumerate(remaining):
+        table.meta['CATCOL{0:02d}'.format(i)] = col
+        table.meta['CATNUM{0:02d}'.format(i)] = len(values)
+        for j, value in enumerate(values):
+            table.meta['C{0:02d}V{1:03d}'.format(i, j)] = value
+
+    return table
+
+class LazyDecodeTable(object):
+    '''
+    Read-only table wrapper that decodes bytes columns to unicode on access
+
+    Args:
+        data : numpy structured array (including FITS_rec) or astropy Table
+
+    Options:
+        encoding : encoding to use for converting bytes into unicode;
+            default 'ascii'; if None, use ENCODING from table metadata
+
+    Bytes columns are decoded the first time they are accessed with
+    ``table[colname]`` and the result is cached; columns that are never
+    accessed stay as zero-copy views of `data`, e.g. of a memory-mapped
+    FITS file.  Use `raw` to get a column without decoding it and
+    `to_table` to get an astropy Table with every column decoded.
+
+    Bytes columns of a FITS_rec, e.g. ``fits.open(filename)[1].data``,
+    are taken from the raw records, since astropy decodes FITS_rec string
+    fields when they are accessed.  Tables read with
+    ``Table.read(filename, memmap=True)`` keep their bytes columns as views
+    of the file, but ``Table(fits_rec)`` has already decoded all of them.
+
+    Note: `encoding` option overides data.meta['ENCODING'];
+        use encoding=None to use data.meta['ENCODING'] instead
+    '''
+    def __init__(self, data, encoding='ascii'):
+        from collections import OrderedDict
+        import numpy as np
+        from astropy.table import Table
+        if isinstance(data, Table):
+            columns = [(name, data[name]) for name in data.colnames]
+        else:
+            #- FITS_rec fields are converted on access (strings to unicode),
+            #- so take the columns from the raw records instead.
+            records = data.view(np.ndarray)
+            columns = [(name, records[name]) for name in records.dtype.names]
+        self.meta = OrderedDict(getattr(data, 'meta', None) or {})
+        self._data = data
+        self._columns = OrderedDict(columns)
+        self._encoding = _pick_encoding(self, encoding)
+        self._decoded = dict()
+
+    @property
+    def colnames(self):
+        '''List of column names'''
+        return list(self._columns.keys())
+
+    @property
+    def encoding(self):
+        '''Encoding used to decode bytes columns'''
+        return self._encoding
+
+    def __len__(self):
+        for column in self._columns.values():
+            return len(column)
+        return 0
+
+    def __contains__(self, colname):
+        return colname in self._columns
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __getitem__(self, colname):
+        '''
+        Return column `colname`, decoding it to unicode if it holds bytes
+        '''
+        try:
+            return self._decoded[colname]
+        except KeyError:
+            pass
+        column = self._columns[colname]
+        if column.dtype.kind != 'S':
+            return self._data[colname]
+        decoded = _decode_column(column, self._encoding)
+        self._decoded[colname] = decoded
+        return decoded
+
+    def raw(self, colname):
+        '''
+        Return column `colname` of the input data, without decoding bytes
+        '''
+        column = self._columns[colname]
+        if column.dtype.kind != 'S':
+            return self._data[colname]
+        return column
+
+    def is_decoded(self, colname):
+        '''
+        Return True if bytes column `colname` has already been decoded
+        '''
+        return colname in self._decoded
+
+    def to_table(self):
+        '''
+        Return astropy Table with all bytes columns decoded to unicode
+        '''
+        from astropy.table import Table
+        table = Table([self[name] for name in self.colnames],
+                      names=self.colnames, meta=self.meta, copy=False)
+        table.meta['ENCODING'] = self._encoding
+        return table
@@ -7,7 +7,11 @@ from __future__ import (absolute_import, division,
 # The line above will help with 2to3 support.
 import sys
 import unittest
-from ..bitmask import BitMask, _MaskBit
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+from ..bitmask import (BitMask, BitMaskIndex, FrozenBitMask, RunLengthMask,
+                        _MaskBit, dilate_mask, reduce_masks)
 import yaml
 import numpy as np
 
@@ -70,6 +74,239 @@ class TestBitMask(unittest.TestCase):
         m = self.ccdmask
         self.assertEqual(m.mask('BAD|COSMIC'), m.BAD | m.COSMIC)
 
+    def test_mask_expression(self):
+        """Test mask expressions and named sub-expressions.
+        """
+        m = self.ccdmask
+        self.assertEqual(m.mask('BAD | COSMIC'), m.BAD | m.COSMIC)
+        self.assertEqual(m.mask('(BAD|HOT|DEAD)&~HOT'), m.BAD | m.DEAD)
+        self.assertEqual(m.mask('~BAD'), m.HOT | m.DEAD | m.SATURATED | m.COSMIC)
+        self.assertEqual(m.mask('0|4'), m.BAD | m.COSMIC)
+        self.assertEqual(m.mask('BAD&HOT'), 0)
+        #- Results are cached
+        self.assertIs(m.predicate('BAD|HOT'), m.predicate('BAD|HOT'))
+        m.define('BADPIX', 'BAD|HOT|DEAD')
+        self.assertEqual(m.mask('BADPIX|COSMIC'), m.mask('BAD|HOT|DEAD|COSMIC'))
+        x = np.array([0, m.BAD, m.BAD | m.COSMIC, m.COSMIC, m.HOT | m.DEAD])
+        self.assertEqual(m.predicate('BADPIX&~COSMIC')(x).tolist(),
+                         [False, True, False, False, True])
+        self.assertEqual(m.predicate('HOT&DEAD | COSMIC')(x).tolist(),
+                         [False, False, True, True, True])
+        self.assertEqual(m.predicate('~(BAD|COSMIC)')(x).tolist(),
+                         [True, False, False, False, True])
+        self.assertEqual(m.predicate('(BAD|HOT)&(COSMIC|DEAD)')(x).tolist(),
+                         [False, False, True, False, True])
+        for expr in ('BAD|', '(BAD', 'BAD)', '', 'BAD COSMIC'):
+            with self.assertRaises(ValueError):
+                m.mask(expr)
+        for expr in ('BAD|BLATFOO', 'BA-D'):
+            with self.assertRaises(KeyError):
+                m.mask(expr)
+        #- Bit names need not be identifiers
+        m2 = BitMask('odd', {'odd': [['A-B', 0, 'dash'], ['2PASS', 1, 'digit'],
+                                     ['12', 3, 'number']]})
+        self.assertEqual(m2.mask('A-B'), 1)
+        self.assertEqual(m2.mask('2PASS'), 2)
+        self.assertEqual(m2.mask('A-B | 2PASS'), 3)
+        self.assertEqual(m2.mask('12'), 8)
+        self.assertEqual(m2.mask('1|3'), 10)
+        #- Bits that do not fit the mask dtype are never all set
+        wide = BitMask('wide', {'wide': [['BAD', 0, ''], ['WIDE', 10, '']]})
+        x8 = np.array([1, 0, 255], dtype=np.uint8)
+        self.assertEqual(wide.predicate('BAD&WIDE')(x8).tolist(),
+                         [False, False, False])
+        self.assertFalse(wide.predicate('BAD&WIDE')(np.uint8(1)))
+        self.assertEqual(wide.predicate('WIDE')(x8).tolist(),
+                         [False, False, False])
+        self.assertEqual(wide.predicate('~WIDE')(x8).tolist(),
+                         [True, True, True])
+        self.assertEqual(wide.predicate('BAD|WIDE')(x8).tolist(),
+                         [True, False, True])
+        #- The expression cache may be shared between threads
+        from multiprocessing.pool import ThreadPool
+        from ..bitmask import _LRUCache
+        c = _LRUCache(maxsize=2)
+        c['a'] = 1
+        self.assertEqual(c.get('a'), 1)
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('b', 0), 0)
+        m._cache.maxsize = 3
+        exprs = ['BAD|HOT', 'HOT|DEAD', 'DEAD|COSMIC', 'BAD|COSMIC', 'HOT&~BAD']
+        expected = [m.mask(e) for e in exprs]
+        pool = ThreadPool(4)
+        try:
+            results = pool.map(lambda i: m.mask(exprs[i % 5]), range(2000))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(results, [expected[i % 5] for i in range(2000)])
+        with self.assertRaises(ValueError):
+            m.define('COSMIC', 'BAD')
+        with self.assertRaises(ValueError):
+            m.define('NOT A NAME', 'BAD')
+
+    def test_select(self):
+        """Test fused any/all/none selection.
+        """
+        m = self.ccdmask
+        x = np.random.RandomState(42).randint(0, 32, size=10001).astype(np.int32)
+        expected = (((x & (m.BAD | m.HOT)) != 0) & ((x & m.COSMIC) != 0) &
+                    ((x & m.DEAD) == 0))
+        for kwargs in ({}, {'chunksize': 100}, {'nthreads': 3, 'chunksize': 77}):
+            sel = m.select(x, any='BAD|HOT', all=['COSMIC'], none='DEAD',
+                           **kwargs)
+            self.assertEqual(sel.dtype, bool)
+            self.assertTrue(np.all(sel == expected))
+        ii = m.select(x, any=['BAD', 'HOT'], all='COSMIC', none=[2],
+                      indices=True)
+        self.assertTrue(np.all(ii == np.flatnonzero(expected)))
+        #- all requires every bit
+        sel = m.select(x, all='BAD|HOT')
+        self.assertTrue(np.all(sel == ((x & 3) == 3)))
+        #- Constraints with no bits still apply
+        self.assertFalse(np.any(m.select(x, any='BAD&HOT')))
+        self.assertFalse(np.any(m.select(x, any=[])))
+        self.assertTrue(np.all(m.select(x, all=[])))
+        self.assertEqual(len(m.select(x, any=[], indices=True)), 0)
+        #- Bits that do not fit the dtype are never set
+        wide = BitMask('wide', {'wide': [['BAD', 0, ''], ['WIDE', 10, '']]})
+        x8 = np.array([0, 1, 255], dtype=np.uint8)
+        self.assertFalse(np.any(wide.select(x8, any='WIDE')))
+        self.assertFalse(np.any(wide.select(x8, all='BAD|WIDE')))
+        self.assertEqual(wide.select(x8, any='BAD|WIDE').tolist(),
+                         [False, True, True])
+        self.assertTrue(np.all(wide.select(x8, none='WIDE')))
+        #- no conditions selects everything; shape is preserved
+        sel = m.select(x[:10].reshape(2, 5))
+        self.assertEqual(sel.shape, (2, 5))
+        self.assertTrue(np.all(sel))
+
+    def test_bitcounts(self):
+        """Test counting set bits in one pass.
+        """
+        m = self.ccdmask
+        x = np.random.RandomState(42).randint(0, 64, size=(100, 37))
+        for dtype in ('u1', '<i2', '>i4', '>u8'):
+            xx = x.astype(dtype)
+            for chunksize in (1, 100, 10**6):
+                counts = m.bitcounts(xx, chunksize=chunksize)
+                self.assertEqual(list(counts.keys()), m.names() + ['UNKNOWN5'])
+                for name in m.names():
+                    self.assertEqual(counts[name], ((x & m[name]) != 0).sum())
+                self.assertEqual(counts['UNKNOWN5'], ((x & 32) != 0).sum())
+        #- Sign bit
+        counts = m.bitcounts(np.array([-2**15, 1], dtype=np.int16))
+        self.assertEqual(counts['BAD'], 1)
+        self.assertEqual(counts['UNKNOWN15'], 1)
+        #- Summary table
+        counts = m.bitcounts(x)
+        summary = m.format_counts(counts, total=x.size).split('\n')
+        self.assertEqual(len(summary), len(counts) + 1)
+        self.assertTrue(summary[1].startswith('BAD'))
+        self.assertTrue(summary[1].endswith(m.BAD.comment))
+        self.assertIn('Fraction', summary[0])
+        summary = m.format_counts(counts).split('\n')
+        self.assertNotIn('Fraction', summary[0])
+        self.assertTrue(summary[-1].startswith('UNKNOWN5'))
+
+    def test_index(self):
+        """Test inverted bit index queries and I/O.
+        """
+        m = self.ccdmask
+        x = np.random.RandomState(42).randint(0, 64, size=1000).astype(np.int32)
+        index = BitMaskIndex(x, m)
+        self.assertEqual(index.nrows, len(x))
+        for name in m.names():
+            self.assertTrue(np.all(index.rows(name) ==
+                                   np.flatnonzero((x & m[name]) != 0)))
+        self.assertTrue(np.all(index.rows(4) == index.rows('COSMIC')))
+        for expr in ('BAD', 'BAD|HOT', 'BAD&HOT', '(BAD|HOT)&~COSMIC',
+                     '~DEAD', 'BAD&HOT&~(COSMIC|SATURATED)'):
+            expected = np.flatnonzero(m.predicate(expr)(x))
+            self.assertTrue(np.all(index.query(expr) == expected))
+            self.assertEqual(index.count(expr), len(expected))
+        self.assertTrue(np.all(index.union('BAD', 'HOT') ==
+                               index.query('BAD|HOT')))
+        self.assertTrue(np.all(index.intersection('BAD', 'HOT', 'DEAD') ==
+                               index.query('BAD&HOT&DEAD')))
+        self.assertTrue(np.all(index.difference('BAD', 'HOT') ==
+                               index.query('BAD&~HOT')))
+        #- Index arrays are shared, so they are read-only
+        with self.assertRaises(ValueError):
+            index.rows('BAD')[0] = 0
+        with self.assertRaises(ValueError):
+            index = BitMaskIndex(x.reshape(10, 100), m)
+        #- I/O
+        tmpdir = mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'index.npz')
+            index.write(filename)
+            for bitmask in (None, m):
+                index2 = BitMaskIndex.read(filename, bitmask=bitmask)
+                self.assertEqual(index2.nrows, index.nrows)
+                self.assertEqual(index2.bitmask.names(), m.names())
+                for name in m.names():
+                    self.assertTrue(np.all(index2.rows(name) == index.rows(name)))
+                self.assertTrue(np.all(index2.query('BAD&~HOT') ==
+                                       index.query('BAD&~HOT')))
+            #- Comments and extras with quotes and backslashes
+            odd = BitMask('odd', {'odd': [
+                ['BAD', 0, 'a "quoted" comment'],
+                ['HOT', 1, 'back\\slash', {'key': "it's"}]]})
+            BitMaskIndex(np.array([0, 1, 2, 3]), odd).write(filename)
+            index3 = BitMaskIndex.read(filename)
+            self.assertEqual(index3.bitmask.comment('BAD'), 'a "quoted" comment')
+            self.assertEqual(index3.bitmask.comment('HOT'), 'back\\slash')
+            self.assertEqual(index3.bitmask.HOT.key, "it's")
+            self.assertEqual(index3.rows('HOT').tolist(), [2, 3])
+        finally:
+            rmtree(tmpdir)
+
+    def test_runlength(self):
+        """Test run-length encoded masks.
+        """
+        m = self.ccdmask
+        rng = np.random.RandomState(42)
+        a = np.zeros((50, 60), dtype=np.int32)
+        b = np.zeros((50, 60), dtype=np.int32)
+        a[rng.randint(0, 50, 40), rng.randint(0, 60, 40)] = rng.randint(1, 32, 40)
+        b[rng.randint(0, 50, 40), rng.randint(0, 60, 40)] = rng.randint(1, 32, 40)
+        a[10, 5:30] = m.COSMIC
+        b[10, 20:50] = m.COSMIC
+        a[-1, -1] = m.BAD
+        ra = RunLengthMask.from_dense(a, m)
+        rb = RunLengthMask.from_dense(b, m)
+        self.assertLess(ra.nbytes, a.nbytes)
+        da = ra.to_dense()
+        self.assertEqual(da.dtype, a.dtype)
+        self.assertTrue(np.all(da == a))
+        for result, expected in ((ra | rb, a | b), (ra & rb, a & b),
+                                 (ra.andnot(rb), a & ~b)):
+            self.assertEqual(result.shape, a.shape)
+            self.assertTrue(np.all(result.to_dense() == expected))
+            #- Runs are merged as if encoded from the dense result
+            self.assertEqual(len(result), len(RunLengthMask.from_dense(expected)))
+        empty = RunLengthMask.from_dense(np.zeros_like(a))
+        self.assertEqual(len(empty), 0)
+        self.assertTrue(np.all((ra | empty).to_dense() == a))
+        self.assertEqual(len(ra & empty), 0)
+        with self.assertRaises(ValueError):
+            ra | RunLengthMask.from_dense(a[:10])
+        with self.assertRaises(ValueError):
+            RunLengthMask.from_dense(a.astype(float))
+        #- Round-trip through a FITS binary table
+        from astropy.table import Table
+        tmpdir = mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'mask.fits')
+            (ra | rb).to_table().write(filename)
+            rc = RunLengthMask.from_table(Table.read(filename), bitmask=m)
+            self.assertTrue(np.all(rc.to_dense() == (a | b)))
+            rc = RunLengthMask.from_table(Table.read(filename))
+            self.assertEqual(rc.bitmask.names(), m.names())
+        finally:
+            rmtree(tmpdir)
+
     def test_access(self):
         """Miscellaneous stuff that should work.
         """
@@ -83,6 +320,46 @@ class TestBitMask(unittest.TestCase):
         self.assertEqual(self.ccdmask.HOT.comment, "Hot pixel")
         self.ccdmask.names()
 
+    def test_lookup_tables(self):
+        """Test lookups that use the precomputed tables.
+        """
+        m = self.ccdmask
+        self.assertEqual(m.bitname(3), 'SATURATED')
+        self.assertEqual(m.comment(3), m.SATURATED.comment)
+        self.assertEqual(m.mask(3), 8)
+        with self.assertRaises(KeyError):
+            m.bitname(5)
+        with self.assertRaises(KeyError):
+            m.bitname(-1)
+        with self.assertRaises(KeyError):
+            m.comment(100)
+        with self.assertRaises(KeyError):
+            m.mask(5)
+        self.assertIs(m[3], m.SATURATED)
+        #- Bits are stored once, keyed by name and listed by number
+        self.assertEqual(sorted(m._bits.keys()), sorted(m.names()))
+        gaps = BitMask('gaps', {'gaps': [['A', 1, 'a'], ['B', 5, 'b']]})
+        self.assertEqual(gaps.names(), ['A', 'B'])
+        self.assertEqual(gaps.names(0x3f), ['UNKNOWN0', 'A', 'UNKNOWN2',
+                                            'UNKNOWN3', 'UNKNOWN4', 'B'])
+        self.assertEqual(gaps.mask('~A'), 32)
+        with self.assertRaises(KeyError):
+            gaps.bitname(2)
+        self.assertEqual(m.names(-1), [])
+        self.assertEqual(m.names(0), [])
+        #- names() returns a new list each time
+        names = m.names()
+        names.append('BLAT')
+        self.assertEqual(m.names(), ['BAD', 'HOT', 'DEAD', 'SATURATED', 'COSMIC'])
+        #- Derived, not stored, bit attributes
+        self.assertNotIn('bitnum', m.HOT.__dict__)
+        self.assertNotIn('mask', m.HOT.__dict__)
+        #- Copies work without recursion in __getattr__
+        from copy import deepcopy
+        m2 = deepcopy(m)
+        self.assertEqual(m2.names(), m.names())
+        self.assertEqual(m2.mask('BAD|HOT'), 3)
+
     def test_badname(self):
         """Test raising AttributeError for bad names.
         """
@@ -148,6 +425,384 @@ class TestBitMask(unittest.TestCase):
             if i<63:
                 names = mask.names(np.array([2**i], dtype=np.int64))
 
+    def test_vectorized_names(self):
+        """Test decoding whole mask arrays.
+        """
+        m = self.ccdmask
+        mask = np.array([0, m.COSMIC, m.COSMIC | m.SATURATED, m.COSMIC,
+                         m.BAD | 2**13], dtype=np.uint16)
+        values, names, inverse = m.unique_names(mask)
+        self.assertEqual(len(values), 4)
+        self.assertEqual(inverse.shape, mask.shape)
+        for i in range(len(mask)):
+            self.assertEqual(names[inverse[i]], m.names(mask[i]))
+        bits = m.bitarray(mask)
+        self.assertEqual(bits.shape, (len(mask), len(m.names())))
+        for j, name in enumerate(m.names()):
+            self.assertTrue(np.all(bits[:, j] == ((mask & m[name]) != 0)))
+        #- Multidimensional arrays keep their shape
+        bits = m.bitarray(mask.reshape(5, 1))
+        self.assertEqual(bits.shape, (5, 1, len(m.names())))
+        values, names, inverse = m.unique_names(mask.reshape(5, 1))
+        self.assertEqual(inverse.shape, (5, 1))
+        #- Signed arrays test the sign bit too
+        bits = m.bitarray(np.array([-1], dtype=np.int8))
+        self.assertTrue(np.all(bits))
+        with self.assertRaises(ValueError):
+            bits = m.bitarray(np.zeros(3, dtype=np.float32))
+
+    def test_multiword(self):
+        """Test masks with more than 64 bits.
+        """
+        _bitdefs = dict(widemask=list())
+        _bitdefs['widemask'].append(['LOW', 0, "bit 0"])
+        _bitdefs['widemask'].append(['TOP', 63, "bit 63"])
+        _bitdefs['widemask'].append(['WIDE', 64, "bit 64"])
+        _bitdefs['widemask'].append(['WIDER', 100, "bit 100"])
+        m = BitMask('widemask', _bitdefs)
+        self.assertEqual(m.nwords, 2)
+        self.assertEqual(self.ccdmask.nwords, 1)
+        self.assertEqual(m.WIDER, 2**100)
+        self.assertEqual(m.mask('LOW|WIDER'), 1 + 2**100)
+        self.assertEqual(m.mask_words('LOW|WIDER').tolist(), [1, 2**36])
+        self.assertEqual(m.mask_words('TOP').tolist(), [2**63, 0])
+        self.assertEqual(m.names(2**64 + 1), ['LOW', 'WIDE'])
+        self.assertEqual(m.names(m.mask_words('TOP|WIDER')), ['TOP', 'WIDER'])
+        x = np.zeros((4, 2), dtype=np.uint64)
+        x[0] = m.mask_words('LOW')
+        x[1] = m.mask_words('WIDE|TOP')
+        x[2] = m.mask_words('WIDER|LOW')
+        bits = m.bitarray(x)
+        self.assertEqual(bits.shape, (4, 4))
+        self.assertEqual(bits.tolist(), [[True, False, False, False],
+                                         [False, True, True, False],
+                                         [True, False, False, True],
+                                         [False, False, False, False]])
+        values, names, inverse = m.unique_names(x)
+        self.assertEqual(inverse.shape, (4,))
+        self.assertEqual(names[inverse[2]], ['LOW', 'WIDER'])
+        self.assertEqual(names[inverse[3]], [])
+        self.assertEqual(m.predicate('WIDE|WIDER')(x).tolist(),
+                         [False, True, True, False])
+        self.assertEqual(m.predicate('LOW&WIDER')(x).tolist(),
+                         [False, False, True, False])
+        self.assertEqual(m.select(x, any='LOW|WIDE', none='WIDER').tolist(),
+                         [True, True, False, False])
+        self.assertEqual(m.select(x, all='TOP|WIDE', chunksize=1).tolist(),
+                         [False, True, False, False])
+        counts = m.bitcounts(x)
+        self.assertEqual(list(counts.values()), [2, 1, 1, 1])
+        index = BitMaskIndex(x, m)
+        self.assertEqual(index.query('LOW|WIDE').tolist(), [0, 1, 2])
+        #- Multi-word masks need the word axis
+        with self.assertRaises(ValueError):
+            m.bitarray(np.zeros(4, dtype=np.uint64))
+        with self.assertRaises(ValueError):
+            m.select(np.zeros((4, 3), dtype=np.uint64), any='LOW')
+
+    def test_dtype(self):
+        """Test minimal mask types and allocators.
+        """
+        m = self.ccdmask
+        self.assertEqual(m.dtype, np.uint8)
+        self.assertEqual(m.zeros((3, 4)).dtype, np.uint8)
+        self.assertEqual(m.zeros((3, 4)).shape, (3, 4))
+        self.assertEqual(m.empty(5).shape, (5,))
+        self.assertTrue(np.all(m.zeros(5) == 0))
+        for bitnum, dtype in ((7, np.uint8), (8, np.uint16), (31, np.uint32),
+                              (32, np.uint64), (63, np.uint64), (64, np.uint64)):
+            bm = BitMask('m', dict(m=[['BIT', bitnum, 'comment']]))
+            self.assertEqual(bm.dtype, dtype)
+        bm = BitMask('m', dict(m=[['BIT', 100, 'comment']]))
+        self.assertEqual(bm.zeros(3).shape, (3, 2))
+        #- Safe downcast
+        x = np.array([0, m.BAD | m.COSMIC, m.DEAD], dtype=np.int64)
+        y = m.downcast(x)
+        self.assertEqual(y.dtype, np.uint8)
+        self.assertTrue(np.all(y == x))
+        x[1] |= 2**40
+        with self.assertRaises(ValueError):
+            y = m.downcast(x)
+
+    def test_dilate(self):
+        """Test dilation of selected mask bits.
+        """
+        m = self.ccdmask
+        rng = np.random.RandomState(42)
+        image = rng.randint(0, 32, size=(40, 30)) * (rng.uniform(size=(40, 30)) < 0.05)
+        image = image.astype(np.int16)
+        structure = np.array([[0, 1, 0, 0, 0],
+                              [1, 1, 1, 1, 0],
+                              [0, 1, 0, 0, 0]], dtype=bool)
+        bits = m.mask('COSMIC|SATURATED')
+        #- Reference: dilate each selected bit separately
+        expected = image.copy()
+        for y, x in zip(*np.nonzero(image & bits)):
+            for i, j in zip(*np.nonzero(structure)):
+                yy, xx = y + i - 1, x + j - 2
+                if 0 <= yy < image.shape[0] and 0 <= xx < image.shape[1]:
+                    expected[yy, xx] |= image[y, x] & bits
+        for tilesize in (None, 1, 7, 100):
+            result = dilate_mask(image, bits, structure, tilesize=tilesize)
+            self.assertEqual(result.dtype, image.dtype)
+            self.assertTrue(np.all(result == expected))
+        #- Other bits are untouched; input is not modified
+        result = dilate_mask(image, m.COSMIC)
+        self.assertTrue(np.all((result & ~m.COSMIC) == (image & ~m.COSMIC)))
+        self.assertTrue(np.all(result >= image))
+        self.assertEqual(dilate_mask(image, 0).tolist(), image.tolist())
+        with self.assertRaises(ValueError):
+            dilate_mask(image, bits, np.ones((2, 2)))
+        with self.assertRaises(ValueError):
+            dilate_mask(image[0], bits)
+
+    def test_reduce(self):
+        """Test streaming reduction of mask stacks.
+        """
+        from astropy.io import fits
+        m = self.ccdmask
+        rng = np.random.RandomState(42)
+        stack = rng.randint(0, 32, size=(6, 20, 10)).astype(np.int32)
+        self.assertTrue(np.all(reduce_masks(iter(stack)) ==
+                               np.bitwise_or.reduce(stack, axis=0)))
+        self.assertTrue(np.all(reduce_masks(stack, op='and') ==
+                               np.bitwise_and.reduce(stack, axis=0)))
+        #- Input can be HDUs, also big-endian
+        hdus = (fits.ImageHDU(frame.astype('>i4')) for frame in stack)
+        result, counts = reduce_masks(hdus, bitmask=m)
+        self.assertTrue(np.all(result == np.bitwise_or.reduce(stack, axis=0)))
+        self.assertEqual(counts.shape, (5, 20, 10))
+        for k, name in enumerate(m.names()):
+            self.assertTrue(np.all(counts[k] == ((stack & m[name]) != 0).sum(axis=0)))
+        #- Input frames are not modified
+        frames = [frame.copy() for frame in stack]
+        result = reduce_masks(frames)
+        self.assertTrue(np.all(frames[0] == stack[0]))
+        with self.assertRaises(ValueError):
+            reduce_masks([])
+        with self.assertRaises(ValueError):
+            reduce_masks(stack, op='xor')
+        with self.assertRaises(ValueError):
+            reduce_masks([stack[0], stack[1, :5]])
+
+    def test_from_yaml(self):
+        """Test loading and caching bit definitions from YAML.
+        """
+        from .. import bitmask as bm
+        tmpdir = mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'bitmasks.yaml')
+            cachedir = os.path.join(tmpdir, 'cache')
+            with open(filename, 'w') as f:
+                f.write(_bitdefyaml)
+            m = BitMask.from_yaml(filename, 'ccdmask', cachedir=cachedir)
+            self.assertEqual(repr(m), repr(self.ccdmask))
+            self.assertEqual(len(os.listdir(cachedir)), 1)
+            self.assertTrue(os.listdir(cachedir)[0].endswith('.json'))
+            #- Mutable bitmasks are not shared between callers
+            m1 = BitMask.from_yaml(filename, 'ccdmask', cachedir=cachedir)
+            self.assertIsNot(m1, m)
+            m1.define('BADPIX', 'BAD|HOT')
+            with self.assertRaises(KeyError):
+                m.mask('BADPIX')
+            #- Frozen bitmasks are shared within a process
+            f = FrozenBitMask.from_yaml(filename, 'ccdmask', cachedir=cachedir)
+            self.assertIsInstance(f, FrozenBitMask)
+            self.assertIs(FrozenBitMask.from_yaml(filename, 'ccdmask',
+                                                  cachedir=cachedir), f)
+            #- A corrupt cache file is ignored
+            cachefile = os.path.join(cachedir, os.listdir(cachedir)[0])
+            with open(cachefile, 'w') as fx:
+                fx.write('not json')
+            bm._bitdefs_memo.clear()
+            self.assertEqual(repr(BitMask.from_yaml(filename, 'ccdmask',
+                                                    cachedir=cachedir)), repr(m))
+            #- Load from the cache file in a new process
+            bm._bitdefs_memo.clear()
+            bm._bitmask_memo.clear()
+            m2 = BitMask.from_yaml(filename, 'ccdmask', cachedir=cachedir)
+            self.assertIsNot(m2, m)
+            self.assertEqual(repr(m2), repr(m))
+            self.assertEqual(m2.HOT.blat, 'foo')
+            #- Changes to the file are noticed
+            with open(filename, 'w') as f:
+                f.write(_bitdefyaml.replace('COSMIC', 'COSMICRAY'))
+            os.utime(filename, (0, 0))
+            m3 = BitMask.from_yaml(filename, 'ccdmask', cachedir=cachedir)
+            self.assertEqual(m3.bitname(4), 'COSMICRAY')
+            self.assertEqual(len(os.listdir(cachedir)), 2)
+            #- The cache file is optional
+            bm._bitdefs_memo.clear()
+            m4 = BitMask.from_yaml(filename, 'ccdmask', cachedir=False)
+            self.assertEqual(m4.bitname(4), 'COSMICRAY')
+            with self.assertRaises(KeyError):
+                BitMask.from_yaml(filename, 'blatmask', cachedir=cachedir)
+        finally:
+            bm._bitdefs_memo.clear()
+            bm._bitmask_memo.clear()
+            rmtree(tmpdir)
+
+    def test_header(self):
+        """Test writing bit definitions to headers.
+        """
+        from astropy.io import fits
+        from astropy.table import Table
+        m = self.ccdmask
+        hdr = fits.Header()
+        m.to_header(hdr)
+        self.assertEqual(hdr['BMNAME'], 'ccdmask')
+        self.assertEqual(hdr['BMNAM01'], 'HOT')
+        self.assertEqual(hdr['BMNUM04'], 4)
+        self.assertEqual(hdr['BMCOM00'], m.BAD.comment)
+        m2 = BitMask.from_header(hdr)
+        self.assertEqual(m2._name, m._name)
+        for name in m.names():
+            self.assertEqual(m2[name].bitnum, m[name].bitnum)
+            self.assertEqual(m2[name].comment, m[name].comment)
+        #- Several masks with different prefixes; rewriting removes old bits
+        small = BitMask('small', dict(small=[['ONLY', 7, 'only bit']]))
+        small.to_header(hdr, prefix='SM')
+        self.assertEqual(BitMask.from_header(hdr, prefix='SM').names(), ['ONLY'])
+        small.to_header(hdr)
+        self.assertEqual(BitMask.from_header(hdr).names(), ['ONLY'])
+        self.assertNotIn('BMNAM01', hdr)
+        with self.assertRaises(ValueError):
+            m.to_header(hdr, prefix='BIT')
+        with self.assertRaises(KeyError):
+            BitMask.from_header(fits.Header())
+        #- Table metadata round-trip through a FITS file
+        t = Table()
+        t['MASK'] = np.array([1, 16, 24], dtype=np.int16)
+        m.to_header(t.meta)
+        tmpdir = mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'table.fits')
+            t.write(filename)
+            m3 = BitMask.from_header(fits.getheader(filename, 1))
+            self.assertEqual(repr(m3).replace(", {'blat': 'foo'}", ''),
+                             repr(m).replace(", {'blat': 'foo'}", ''))
+        finally:
+            rmtree(tmpdir)
+
+    def test_pickle(self):
+        """Test pickling bitmasks.
+        """
+        import pickle
+        m = self.ccdmask
+        m.define('BADPIX', 'BAD|HOT|DEAD')
+        m.predicate('BADPIX')    #- caches a function, which can't be pickled
+        m2 = pickle.loads(pickle.dumps(m))
+        self.assertEqual(repr(m2), repr(m))
+        self.assertEqual(m2.HOT.blat, 'foo')
+        self.assertEqual(m2.mask('BADPIX'), 7)
+
+    def test_frozen(self):
+        """Test immutable, hashable bitmasks.
+        """
+        import pickle
+        m = self.ccdmask
+        f = m.freeze()
+        self.assertIsInstance(f, FrozenBitMask)
+        self.assertIs(f.freeze(), f)
+        self.assertEqual(repr(f), repr(m))
+        self.assertEqual(f.mask('BAD|COSMIC'), 17)
+        self.assertEqual(f.HOT.blat, 'foo')
+        f2 = FrozenBitMask('ccdmask', _bitdefs)
+        self.assertEqual(f, f2)
+        self.assertFalse(f != f2)
+        self.assertEqual(hash(f), hash(f2))
+        #- The hash does not depend on PYTHONHASHSEED
+        self.assertEqual(hash(f), hash(397874444888214419))
+        self.assertEqual(len(set([f, f2])), 1)
+        cache = {f: 'cached'}
+        self.assertEqual(cache[f2], 'cached')
+        other = BitMask('ccdmask', yaml.load(_bitdefyaml.replace('Cosmic ray', 'CR')))
+        self.assertNotEqual(f, other.freeze())
+        self.assertNotEqual(f, m)
+        #- Immutable
+        with self.assertRaises(AttributeError):
+            f._name = 'blat'
+        with self.assertRaises(AttributeError):
+            del f._bits
+        with self.assertRaises(TypeError):
+            f.define('BADPIX', 'BAD|HOT')
+        #- The bits are immutable too, and do not share extras with m
+        with self.assertRaises(AttributeError):
+            f.BAD.comment = 'x'
+        with self.assertRaises(AttributeError):
+            del f.HOT.blat
+        self.assertEqual(f.comment('BAD'), m.comment('BAD'))
+        self.assertIsNot(f.HOT._extra, m.HOT._extra)
+        m.HOT._extra['blat'] = 'bar'
+        self.assertEqual(f.HOT._extra['blat'], 'foo')
+        m.HOT._extra['blat'] = 'foo'
+        m.BAD.comment = 'Changed'
+        self.assertEqual(f, f2)
+        m.BAD.comment = _bitdefs['ccdmask'][0][2]
+        #- Compact pickle
+        p = pickle.dumps(f)
+        self.assertLess(len(p), len(pickle.dumps(m.__dict__)))
+        f3 = pickle.loads(p)
+        self.assertEqual(f3, f)
+        self.assertEqual(hash(f3), hash(f))
+        self.assertEqual(f3.HOT.blat, 'foo')
+
+    def test_to_strings(self):
+        """Test converting mask arrays to strings of names.
+        """
+        m = self.ccdmask
+        x = np.array([[0, m.BAD | m.COSMIC], [m.HOT, m.BAD | m.COSMIC]],
+                     dtype=np.int32)
+        strings = m.to_strings(x)
+        self.assertEqual(strings.dtype, np.dtype('U10'))
+        self.assertEqual(strings.tolist(), [['', 'BAD|COSMIC'], ['HOT', 'BAD|COSMIC']])
+        strings = m.to_strings(x, sep=',', kind='S')
+        self.assertEqual(strings.dtype.kind, 'S')
+        self.assertEqual(strings[0, 1], b'BAD,COSMIC')
+        labels, codes = m.to_strings(x, categorical=True)
+        self.assertEqual(labels.tolist(), ['', 'HOT', 'BAD|COSMIC'])
+        self.assertEqual(codes.shape, x.shape)
+        self.assertTrue(np.all(labels[codes] == m.to_strings(x)))
+        for i, value in enumerate(x.ravel()):
+            self.assertEqual(m.to_strings(x).ravel()[i], '|'.join(m.names(value)))
+        self.assertEqual(m.to_strings(np.zeros(0, dtype=np.int32)).shape, (0,))
+        with self.assertRaises(ValueError):
+            m.to_strings(x, kind='O')
+
+    def test_from_strings(self):
+        """Test converting strings of names to mask arrays.
+        """
+        m = self.ccdmask
+        strings = np.array(['', 'BAD|COSMIC', 'HOT', ' BAD | COSMIC ', 'HOT'])
+        x = m.from_strings(strings)
+        #- Many distinct strings do not evict compiled expressions
+        select = m.predicate('BAD|HOT')
+        many = np.array([' ' * i + 'BAD' for i in range(300)])
+        self.assertTrue(np.all(m.from_strings(many) == m.BAD))
+        self.assertIs(m.predicate('BAD|HOT'), select)
+        self.assertEqual(x.dtype, m.dtype)
+        self.assertEqual(x.tolist(), [0, 17, 2, 17, 2])
+        x = m.from_strings(strings.astype('S').reshape(5, 1))
+        self.assertEqual(x.shape, (5, 1))
+        self.assertEqual(x.ravel().tolist(), [0, 17, 2, 17, 2])
+        self.assertEqual(m.from_strings(['BAD,DEAD'], sep=',').tolist(), [5])
+        #- Round trip
+        y = np.arange(32, dtype=np.uint8)
+        self.assertTrue(np.all(m.from_strings(m.to_strings(y)) == y))
+        #- Unknown names are all reported
+        bad = np.array(['BAD|BLAT', 'FOO', 'BLAT', 'HOT'])
+        with self.assertRaises(ValueError) as e:
+            m.from_strings(bad)
+        self.assertIn('BLAT (2 elements)', str(e.exception))
+        self.assertIn('FOO (1 elements)', str(e.exception))
+        with self.assertRaises(ValueError):
+            m.from_strings(np.arange(3))
+        #- Multi-word masks
+        wide = BitMask('wide', dict(wide=[['LOW', 0, 'low'], ['HIGH', 70, 'high']]))
+        x = wide.from_strings(['LOW|HIGH', 'HIGH', ''])
+        self.assertEqual(x.shape, (3, 2))
+        self.assertEqual(wide.names(x[0]), ['LOW', 'HIGH'])
+
     def test_print(self):
         """Test string representations.
         """
@@ -136,6 +136,50 @@ class TestFuncFits(unittest.TestCase):
         y2 = func_val(x2, dfit)
         np.testing.assert_allclose(y2[50], 0.99941444872371643)
 
+    def test_iterfit_irls(self):
+        """Test iter fit with IRLS robust loss functions.
+        """
+        # Generate data
+        x = np.linspace(0, np.pi, 100)
+        y = np.sin(x)
+        #
+        y[50] = 3.
+        # Fit
+        for method in ('huber', 'tukey'):
+            dfit, mask, weights = iter_fit(x, y, 'legendre', 4, method=method,
+                                           return_weights=True)
+            self.assertEqual(mask.sum(), 1)
+            self.assertEqual(mask[50], 1)
+            self.assertEqual(weights.shape, x.shape)
+            self.assertLess(weights[50], 1e-3)
+            self.assertGreater(np.median(weights), 0.5)
+            y2 = func_val(x, dfit)
+            np.testing.assert_allclose(y2[50], 0.9994, rtol=1e-4)
+        # Tukey weights vanish for the outlier
+        dfit, mask, weights = iter_fit(x, y, 'legendre', 4, method='tukey',
+                                       return_weights=True)
+        self.assertEqual(weights[50], 0.0)
+        # Initial mask is respected
+        imask = np.zeros(x.size, dtype=int)
+        imask[10] = 1
+        dfit, mask, weights = iter_fit(x, y, 'legendre', 4, method='huber',
+                                       initialmask=imask, return_weights=True)
+        self.assertEqual(mask[10], 1)
+        self.assertEqual(weights[10], 0.0)
+        # Same return values for all methods
+        self.assertEqual(len(iter_fit(x, y, 'legendre', 4, method='huber')), 2)
+        dfit, mask, weights = iter_fit(x, y, 'legendre', 4, return_weights=True)
+        self.assertEqual(weights[50], 0.0)
+        self.assertEqual(weights.sum(), x.size - mask.sum())
+        with catch_warnings(record=True) as w:
+            simplefilter('always')
+            dfit, mask = iter_fit(x, y, 'legendre', 4, method='huber',
+                                  max_rej=2)
+            self.assertEqual(len(w), 1)
+            self.assertIn('max_rej', str(w[0].message))
+        with self.assertRaises(ValueError):
+            dfit = iter_fit(x, y, 'legendre', 4, method='cauchy')
+
 
 def test_suite():
     """Allows testing of only this module with the command::
@@ -5,11 +5,16 @@
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 # The line above will help with 2to3 support.
+import os
+import mmap
 import unittest
 import sys
+from tempfile import mkdtemp
+from shutil import rmtree
 import numpy as np
 from astropy.table import Table
 from ..io import combine_dicts, decode_table, encode_table, yamlify
+from ..bitmask import BitMask
 
 try:
     basestring
@@ -119,6 +124,320 @@ class TestIO(unittest.TestCase):
         self.assertTrue(np.all(t2['x'] == data['x']))
         self.assertTrue(np.all(t2['y'] == data['y']))
 
+    def test_encode_fastpath(self):
+        """Test direct code point cast when encoding ASCII data.
+        """
+        from ..io import _encode_column
+        x = np.array([['a', 'bb', ''], ['dddd', 'e\x00f', 'ghi']], dtype='U4')
+        for encoding in ('ascii', 'utf-8', 'latin-1'):
+            y = _encode_column(x, encoding)
+            self.assertEqual(y.dtype, np.dtype('S4'))
+            self.assertEqual(y.shape, x.shape)
+            self.assertTrue(np.all(y == np.char.encode(x, encoding)))
+        #- Non-contiguous and non-native input
+        data = np.zeros(3, dtype=[(str('x'), '>U3'), (str('y'), 'f8')])
+        data['x'] = ['a', 'bc', 'def']
+        self.assertEqual(_encode_column(data['x'], 'ascii').tolist(),
+                         [b'a', b'bc', b'def'])
+        #- Characters beyond the fast path fall back to the general path
+        z = np.array(['a', '\xb5', '\u20ac'], dtype='U2')
+        self.assertEqual(_encode_column(z, 'utf-8').tolist(),
+                         [b'a', b'\xc2\xb5', b'\xe2\x82'])
+        self.assertEqual(_encode_column(z[:2], 'latin-1').tolist(),
+                         [b'a', b'\xb5'])
+        with self.assertRaises(UnicodeEncodeError):
+            _encode_column(z[:2], 'ascii')
+        with self.assertRaises(UnicodeEncodeError):
+            _encode_column(z, 'latin-1')
+        #- Other encodings use the general path
+        self.assertEqual(_encode_column(x, 'utf-16-le')[0, 1], b'b\x00b')
+        self.assertEqual(_encode_column(np.zeros(0, dtype='U3'), 'ascii').dtype,
+                         np.dtype('S3'))
+
+    def test_decode_fastpath(self):
+        """Test direct widening when decoding ASCII data.
+        """
+        from ..io import _decode_column
+        x = np.array([[b'a', b'bb', b''], [b'dddd', b'e\x00f', b'ghi']], dtype='S4')
+        for encoding in ('ascii', 'utf-8', 'latin-1'):
+            y = _decode_column(x, encoding)
+            self.assertEqual(y.dtype, np.dtype('U4'))
+            self.assertEqual(y.shape, x.shape)
+            self.assertTrue(np.all(y == np.char.decode(x, encoding)))
+        #- Non-contiguous input
+        data = np.zeros(3, dtype=[(str('x'), 'S3'), (str('y'), 'f8')])
+        data['x'] = [b'a', b'bc', b'def']
+        self.assertEqual(_decode_column(data['x'], 'ascii').tolist(),
+                         ['a', 'bc', 'def'])
+        #- High bit set falls back to the general path
+        z = np.array([b'a', b'\xc2\xb5'], dtype='S2')
+        self.assertEqual(_decode_column(z, 'utf-8').tolist(), ['a', '\xb5'])
+        self.assertEqual(_decode_column(z, 'latin-1').tolist(), ['a', '\xc2\xb5'])
+        with self.assertRaises(UnicodeDecodeError):
+            _decode_column(z, 'ascii')
+
+    def test_encode_decode_inplace(self):
+        """Test in-place and column-selective encode_table / decode_table.
+        """
+        from astropy.table import Table
+        from ..io import encode_table, decode_table
+        t = Table()
+        t['a'] = np.array(['a', 'bb'], dtype='U2')
+        t['b'] = np.array(['ccc', 'd'], dtype='U3')
+        t['x'] = np.arange(2)
+        t2 = encode_table(t, inplace=True, columns=['a', 'x'])
+        self.assertIs(t2, t)
+        self.assertEqual(t['a'].dtype, np.dtype('S2'))
+        self.assertEqual(t['b'].dtype, np.dtype('U3'))
+        self.assertEqual(t['x'].dtype.kind, 'i')
+        encode_table(t, inplace=True)
+        self.assertEqual(t['b'].dtype, np.dtype('S3'))
+        t3 = decode_table(t, columns=['b'])
+        self.assertIsNot(t3, t)
+        self.assertEqual(t3['a'].dtype, np.dtype('S2'))
+        self.assertEqual(t3['b'].dtype, np.dtype('U3'))
+        self.assertEqual(t['b'].dtype, np.dtype('S3'))
+        decode_table(t, inplace=True)
+        self.assertEqual(t['a'].tolist(), ['a', 'bb'])
+        self.assertEqual(t['b'].tolist(), ['ccc', 'd'])
+        with self.assertRaises(KeyError):
+            encode_table(t, columns=['nope'])
+        with self.assertRaises(ValueError):
+            encode_table(t.as_array(), inplace=True)
+        with self.assertRaises(ValueError):
+            decode_table(t.as_array(), inplace=True)
+
+    def test_lazy_decode(self):
+        """Test LazyDecodeTable.
+        """
+        from astropy.table import Table
+        from ..io import LazyDecodeTable
+        data = np.zeros(3, dtype=[(str('a'), 'S2'), (str('b'), 'S3'), (str('x'), 'i4')])
+        data['a'] = [b'a', b'bb', b'c']
+        data['b'] = [b'ddd', b'e', b'ff']
+        data['x'] = [1, 2, 3]
+        t = LazyDecodeTable(data)
+        self.assertEqual(t.colnames, ['a', 'b', 'x'])
+        self.assertEqual(len(t), 3)
+        self.assertIn('a', t)
+        self.assertFalse(t.is_decoded('a'))
+        a = t['a']
+        self.assertEqual(a.tolist(), ['a', 'bb', 'c'])
+        self.assertTrue(t.is_decoded('a'))
+        self.assertIs(t['a'], a)
+        self.assertFalse(t.is_decoded('b'))
+        self.assertTrue(np.may_share_memory(t.raw('b'), data))
+        self.assertEqual(t['x'].tolist(), [1, 2, 3])
+        self.assertFalse(t.is_decoded('x'))
+        with self.assertRaises(KeyError):
+            t['nope']
+        tt = t.to_table()
+        self.assertEqual(tt['b'].dtype, np.dtype('U3'))
+        self.assertEqual(tt['b'].tolist(), ['ddd', 'e', 'ff'])
+        self.assertEqual(tt.meta['ENCODING'], 'ascii')
+        #- Table input and encoding from metadata
+        table = Table(data, meta={'ENCODING': 'latin-1'})
+        t = LazyDecodeTable(table, encoding=None)
+        self.assertEqual(t.encoding, 'latin-1')
+        self.assertEqual(t['b'].tolist(), ['ddd', 'e', 'ff'])
+        with self.assertRaises(UnicodeError):
+            LazyDecodeTable(data, encoding=None)
+        #- Memory-mapped FITS tables keep undecoded columns on disk
+        from astropy.io import fits
+        tmpdir = mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'lazy.fits')
+            data['x'] = [1, 0, 3]
+            fits.writeto(filename, data)
+            with fits.open(filename, memmap=True) as hdus:
+                fitsdata = hdus[1].data
+                t = LazyDecodeTable(fitsdata)
+                self.assertEqual(t.raw('b').dtype.kind, 'S')
+                self.assertTrue(np.may_share_memory(t.raw('b'), fitsdata.view(np.ndarray)))
+                base = t.raw('b')
+                while getattr(base, 'base', None) is not None:
+                    base = base.base
+                self.assertIsInstance(base, mmap.mmap)
+                self.assertFalse(t.is_decoded('b'))
+                self.assertEqual(t['b'].tolist(), ['ddd', 'e', 'ff'])
+                self.assertTrue(t.is_decoded('b'))
+                self.assertEqual(t['x'].tolist(), [1, 0, 3])
+                del t, fitsdata
+            t = LazyDecodeTable(Table.read(filename, memmap=True))
+            self.assertEqual(t.raw('a').dtype.kind, 'S')
+            self.assertEqual(t['a'].tolist(), ['a', 'bb', 'c'])
+            del t
+        finally:
+            rmtree(tmpdir)
+
+    def test_table_blocks(self):
+        """Test streaming FITS tables in blocks of rows.
+        """
+        from astropy.io import fits
+        from astropy.table import Table, vstack
+        from ..io import iter_table_blocks, write_table_blocks
+        tmpdir = mkdtemp()
+        try:
+            t = Table()
+            t['name'] = np.array(['a', 'bb', 'ccc', 'dd', 'e', 'fff', 'g'])
+            t['x'] = np.arange(7, dtype='f8')
+            t['v'] = np.arange(21, dtype='i2').reshape(7, 3)
+            t.meta['USERKEY'] = 'blat'
+            t.meta['comments'] = ['first', 'second']
+            BitMask('ccdmask', {'ccdmask': [['BAD', 0, 'Bad pixel'],
+                                            ['HOT', 1, 'Hot pixel']]}).to_header(t.meta)
+            infile = os.path.join(tmpdir, 'in.fits')
+            outfile = os.path.join(tmpdir, 'out.fits')
+            t.write(infile)
+            blocks = list(iter_table_blocks(infile, rows=3))
+            self.assertEqual([len(b) for b in blocks], [3, 3, 1])
+            self.assertEqual(blocks[0]['name'].dtype.kind, 'U')
+            self.assertEqual(blocks[2].meta['USERKEY'], 'blat')
+            self.assertNotIn('NAXIS2', blocks[0].meta)
+            self.assertNotIn('TTYPE1', blocks[0].meta)
+            self.assertEqual(vstack(blocks)['name'].tolist(), t['name'].tolist())
+            raw = next(iter_table_blocks(infile, rows=2, decode=False))
+            self.assertEqual(raw['name'].dtype.kind, 'S')
+            #- Round trip through streaming writer
+            n = write_table_blocks(outfile, iter_table_blocks(infile, rows=3),
+                                   extname='DATA')
+            self.assertEqual(n, 7)
+            self.assertEqual(os.path.getsize(outfile) % 2880, 0)
+            with fits.open(outfile, checksum=True) as hdus:
+                self.assertEqual(hdus[1].header['EXTNAME'], 'DATA')
+                self.assertEqual(hdus[1].header['NAXIS2'], 7)
+                data = hdus[1].data
+                self.assertEqual(data['name'].tolist(), t['name'].tolist())
+                self.assertTrue(np.all(data['x'] == t['x']))
+                self.assertTrue(np.all(data['v'] == t['v']))
+            #- Header keywords are kept
+            t2 = Table.read(outfile)
+            self.assertEqual(t2.meta['USERKEY'], 'blat')
+            self.assertEqual(t2.meta['comments'], ['first', 'second'])
+            m = BitMask.from_header(t2.meta)
+            self.assertEqual(m.names(), ['BAD', 'HOT'])
+            self.assertEqual(m.comment('HOT'), 'Hot pixel')
+            #- Narrower later blocks are padded; wider ones are rejected
+            narrow = Table([np.array(['x', 'y'])], names=['name'])
+            wide = Table([np.array(['xyz'])], names=['name'])
+            n = write_table_blocks(outfile, [wide, narrow], overwrite=True)
+            self.assertEqual(n, 3)
+            with fits.open(outfile) as hdus:
+                self.assertEqual(hdus[1].data['name'].tolist(), ['xyz', 'x', 'y'])
+            with self.assertRaises(IOError):
+                write_table_blocks(outfile, [t])
+            #- Errors leave no file behind and keep an existing file
+            def failing():
+                yield wide
+                raise RuntimeError('read error')
+            for blocks in ([narrow, wide], [t, t['x', 'v']], [], failing()):
+                with self.assertRaises((ValueError, RuntimeError)):
+                    write_table_blocks(outfile, blocks, overwrite=True)
+                with fits.open(outfile) as hdus:
+                    self.assertEqual(hdus[1].header['NAXIS2'], 3)
+            os.remove(outfile)
+            for blocks in ([narrow, wide], [t, t['x', 'v']], [], failing()):
+                with self.assertRaises((ValueError, RuntimeError)):
+                    write_table_blocks(outfile, blocks)
+                self.assertFalse(os.path.exists(outfile))
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['in.fits'])
+        finally:
+            rmtree(tmpdir)
+
+    def test_endecode_workers(self):
+        """Test converting columns on multiple threads.
+        """
+        from ..io import encode_table, decode_table
+        t = Table()
+        for i in range(6):
+            t['c{}'.format(i)] = np.array(['x' * (i + 2), 'y', '\xb5'[:i % 2]])
+        t['n'] = np.arange(3)
+        serial = encode_table(t, encoding='utf-8')
+        parallel = encode_table(t, encoding='utf-8', workers=4)
+        self.assertEqual(parallel.colnames, serial.colnames)
+        for col in serial.colnames:
+            self.assertEqual(parallel[col].dtype, serial[col].dtype)
+            self.assertTrue(np.all(parallel[col] == serial[col]))
+        t2 = decode_table(parallel, encoding='utf-8', workers=3)
+        for col in t.colnames:
+            self.assertEqual(t2[col].dtype, t[col].dtype)
+            self.assertEqual(t2[col].tolist(), t[col].tolist())
+
+    def test_encode_shrink(self):
+        """Test encoding to the narrowest bytes width.
+        """
+        from ..io import encode_table, _encode_column
+        t = Table()
+        t['a'] = np.array(['ab', 'c', ''], dtype='U100')
+        t['b'] = np.array(['', '', ''], dtype='U8')
+        t['c'] = np.array([['x', 'yyy'], ['zz', '']], dtype='U10')[[0, 1, 1]]
+        t['n'] = np.arange(3)
+        with self.assertLogs('desiutil.io.encode_table', level='DEBUG') as cm:
+            t2 = encode_table(t, shrink=True)
+        self.assertEqual(t2['a'].dtype, np.dtype('S2'))
+        self.assertEqual(t2['b'].dtype, np.dtype('S1'))
+        self.assertEqual(t2['c'].dtype, np.dtype('S3'))
+        self.assertEqual(t2['c'].shape, (3, 2))
+        self.assertEqual(np.asarray(t2['a']).tolist(), [b'ab', b'c', b''])
+        self.assertEqual(np.asarray(t2['c'])[0].tolist(), [b'x', b'yyy'])
+        self.assertIn('saved {0:d} bytes'.format(3*98 + 3*7 + 6*7), cm.output[-1])
+        self.assertEqual(encode_table(t)['a'].dtype, np.dtype('S100'))
+        #- Non-ASCII values may need more bytes than characters
+        x = np.array(['a', '\xb5\xb5'], dtype='U5')
+        self.assertEqual(_encode_column(x, 'utf-8', shrink=True).tolist(),
+                         [b'a', '\xb5\xb5'.encode('utf-8')])
+
+    def test_categorical(self):
+        """Test dictionary encoding of string columns.
+        """
+        from ..io import encode_categorical, decode_categorical, get_categories
+        t = Table()
+        t['OBJTYPE'] = np.array(['TGT', 'SKY', 'TGT', '', 'SKY'], dtype='U10')
+        t['SPECTYPE'] = np.array([b'GALAXY', b'QSO', b'STAR', b'QSO', b'GALAXY'])
+        t['NAME'] = np.array(['a', 'b', 'c', 'd', 'e'])
+        t['X'] = np.arange(5)
+        t2 = encode_categorical(t, columns=['OBJTYPE', 'SPECTYPE', 'X'])
+        self.assertEqual(t['OBJTYPE'].dtype.kind, 'U')
+        self.assertEqual(t2['OBJTYPE'].dtype, np.dtype('u1'))
+        self.assertEqual(t2['OBJTYPE'].tolist(), [2, 1, 2, 0, 1])
+        self.assertEqual(t2['NAME'].dtype.kind, 'U')
+        self.assertEqual(t2.meta['CATCOL00'], 'OBJTYPE')
+        self.assertEqual(t2.meta['CATNUM00'], 3)
+        self.assertEqual(t2.meta['C01V002'], 'STAR')
+        self.assertEqual(get_categories(t2.meta, 'SPECTYPE'),
+                         ['GALAXY', 'QSO', 'STAR'])
+        with self.assertRaises(KeyError):
+            get_categories(t2.meta, 'NAME')
+        #- Round trip through a FITS file
+        tmpdir = mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'cat.fits')
+            t2.write(filename)
+            t3 = decode_categorical(Table.read(filename), columns=['SPECTYPE'])
+            self.assertEqual(t3['SPECTYPE'].tolist(), t['SPECTYPE'].astype(str).tolist())
+            self.assertEqual(t3.meta['CATCOL00'], 'OBJTYPE')
+            self.assertNotIn('CATCOL01', t3.meta)
+            self.assertNotIn('C01V000', t3.meta)
+            #- Unknown names leave the table unchanged, even in place
+            meta = dict(t3.meta)
+            with self.assertRaises(KeyError):
+                decode_categorical(t3, columns=['OBJTYPE', 'NAME'], inplace=True)
+            self.assertEqual(t3['OBJTYPE'].dtype, np.dtype('u1'))
+            self.assertEqual(dict(t3.meta), meta)
+            t4 = decode_categorical(t3)
+            self.assertEqual(t4['OBJTYPE'].tolist(), t['OBJTYPE'].tolist())
+            self.assertNotIn('CATCOL00', t4.meta)
+        finally:
+            rmtree(tmpdir)
+        #- Limits and code types
+        t5 = encode_categorical(t, 'SPECTYPE', maxvalues=3)
+        self.assertEqual(t5['SPECTYPE'].dtype, np.dtype('u1'))
+        self.assertEqual(t5['OBJTYPE'].dtype.kind, 'U')
+        with self.assertRaises(ValueError):
+            encode_categorical(t, columns=['NAME'], maxvalues=3)
+        big = Table([np.arange(300).astype(str)], names=['ID'])
+        self.assertEqual(encode_categorical(big, ['ID'])['ID'].dtype, np.dtype('u2'))
+
     def test_yamlify(self):
         """Test yamlify
         """